@@ -5,6 +5,55 @@ from past.builtins import xrange
 def softmax(z,j):
     return np.divide(np.exp(z[j]),np.sum(np.exp(z)))
 
+def softmax_cross_entropy(f, y, label_smoothing=0.0, class_weights=None):
+  """
+  Fused softmax and cross-entropy of the scores f, of shape (N, C), against
+  the labels y, of shape (N,).
+
+  The shifted scores are exponentiated once, into the array that becomes the
+  gradient, and the loss is taken from the scores and the per-row log-sum-exp,
+  so no second exp or full-size log is needed. df has the dtype of f.
+
+  The target for f[i] puts 1 - label_smoothing on y[i] and spreads
+  label_smoothing evenly over the C classes. If class_weights (shape (C,)) is
+  given, example i is weighted by class_weights[y[i]] and the loss is divided
+  by the sum of the weights instead of N.
+
+  Returns a tuple of:
+  - loss as single float
+  - gradient with respect to f; an array of same shape as f
+  """
+  num_train, num_classes = f.shape
+  rows = np.arange(num_train)
+
+  shift = np.amax(f, axis=1, keepdims=True)
+  df = np.subtract(f, shift)
+  np.exp(df, out=df)
+  Z = np.sum(df, axis=1, keepdims=True)
+  log_Z = (shift + np.log(Z))[:, 0]
+
+  # -log p[i, y[i]], mixed with the mean of -log p[i, j] when smoothing
+  sample_loss = log_Z - f[rows, y]
+  if label_smoothing:
+    sample_loss *= 1 - label_smoothing
+    sample_loss += label_smoothing * (log_Z - np.mean(f, axis=1))
+
+  if class_weights is None:
+    scale = 1.0 / num_train
+    loss = np.sum(sample_loss) * scale
+  else:
+    sample_weights = np.asarray(class_weights)[y]
+    scale = (sample_weights / np.sum(sample_weights))[:, np.newaxis]
+    loss = np.dot(sample_loss, scale[:, 0])
+
+  # df = (softmax(f) - targets) * scale, written over the exponentials
+  df /= Z
+  if label_smoothing:
+    df -= label_smoothing / num_classes
+  df[rows, y] -= 1 - label_smoothing
+  df *= scale
+  return loss, df
+
 def softmax_loss_naive(W, X, y, reg):
   """
   Softmax loss function, naive implementation (with loops)
@@ -57,11 +106,13 @@ def softmax_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def softmax_loss_vectorized(W, X, y, reg):
+def softmax_loss_vectorized(W, X, y, reg, label_smoothing=0.0,
+                            class_weights=None):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive; label_smoothing and
+  class_weights are passed on to softmax_cross_entropy.
   """
   # Initialize the loss and gradient to zero.
   loss = 0.0
@@ -73,31 +124,17 @@ def softmax_loss_vectorized(W, X, y, reg):
   # here, it is easy to run into numeric instability. Don't forget the        #
   # regularization!                                                           #
   #############################################################################
-  num_classes = W.shape[1]
-  num_train = X.shape[0]
-    
   f = np.dot(X,W)
-  f -= np.amax(f, axis=1).reshape(num_train,1)
-    
-  loss = -np.sum(np.log(np.divide(np.exp(f[range(num_train),y]),np.sum(np.exp(f),axis=1))))
-  
-  # Scale each sample by the softmax of f
-  # df = np.divide(np.exp(f),np.sum(np.exp(f),axis=1).reshape((num_train,1)))
-  df = np.divide(np.exp(f),np.sum(np.exp(f),axis=1, keepdims=True))
 
-  # Subtract off X[i] for correct class 
-  df[range(num_train),y] -= 1
-  
+  # Loss and gradient of the scores, already normalized by the batch
+  loss, df = softmax_cross_entropy(f, y, label_smoothing, class_weights)
+
   dW = np.matmul(X.T,df)
-    
-  # Normalize
-  loss /= num_train
-  dW /= num_train
-  
+
   # Regularization contribution
   loss += reg*np.sum(W*W)
   dW += reg*2.0*W
- 
+
   #############################################################################
   #                          END OF YOUR CODE                                 #
   #############################################################################
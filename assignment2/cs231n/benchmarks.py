@@ -0,0 +1,406 @@
+from __future__ import print_function, division
+from builtins import range
+from time import time
+
+import numpy as np
+
+from cs231n import fast_layers
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.im2col import *
+from cs231n.layer_utils import *
+
+
+def time_function(f, *args, **kwargs):
+    """
+    Return the best wall clock time in seconds over num_trials calls of
+    f(*args), along with the output of the last call.
+    """
+    num_trials = kwargs.pop('num_trials', 3)
+    best = None
+    for _ in range(num_trials):
+        t0 = time()
+        result = f(*args)
+        t1 = time()
+        if best is None or t1 - t0 < best:
+            best = t1 - t0
+    return best, result
+
+
+def benchmark_layouts(N=50, C=3, H=32, W=32, num_filters=32, filter_size=7,
+                      dtype=np.float32, num_trials=3):
+    """
+    Compare the NCHW and NHWC layouts for the conv - spatial batchnorm -
+    max pool layers of a ThreeLayerConvNet-sized network, printing the forward
+    and backward time of each layer in both layouts.
+    """
+    x = np.random.randn(N, C, H, W).astype(dtype)
+    w = np.random.randn(num_filters, C, filter_size, filter_size).astype(dtype)
+    b = np.random.randn(num_filters).astype(dtype)
+    gamma = np.ones(num_filters, dtype=dtype)
+    beta = np.zeros(num_filters, dtype=dtype)
+
+    times = {}
+    for layout in ('NCHW', 'NHWC'):
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                      'layout': layout}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                      'layout': layout}
+        bn_param = {'mode': 'train', 'layout': layout}
+        xl = x if layout == 'NCHW' else np.ascontiguousarray(x.transpose(0, 2, 3, 1))
+
+        t_conv, (a, conv_cache) = time_function(
+            conv_forward_strides, xl, w, b, conv_param, num_trials=num_trials)
+        t_bn, (an, bn_cache) = time_function(
+            spatial_batchnorm_forward, a, gamma, beta, bn_param,
+            num_trials=num_trials)
+        t_pool, (out, pool_cache) = time_function(
+            max_pool_forward_fast, an, pool_param, num_trials=num_trials)
+
+        dout = np.random.randn(*out.shape).astype(dtype)
+        t_dpool, dan = time_function(
+            max_pool_backward_fast, dout, pool_cache, num_trials=num_trials)
+        t_dbn, (da, _, _) = time_function(
+            spatial_batchnorm_backward, dan, bn_cache, num_trials=num_trials)
+        t_dconv, _ = time_function(
+            conv_backward_strides, da, conv_cache, num_trials=num_trials)
+
+        times[layout] = [('conv forward', t_conv), ('conv backward', t_dconv),
+                         ('batchnorm forward', t_bn),
+                         ('batchnorm backward', t_dbn),
+                         ('pool forward', t_pool), ('pool backward', t_dpool)]
+
+    print('%-20s %10s %10s %10s' % ('layer', 'NCHW', 'NHWC', 'saved'))
+    for (name, t_nchw), (_, t_nhwc) in zip(times['NCHW'], times['NHWC']):
+        print('%-20s %9.4fs %9.4fs %9.4fs' % (name, t_nchw, t_nhwc,
+                                              t_nchw - t_nhwc))
+    return times
+
+
+def rel_error(x, y):
+    """ returns relative error """
+    return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
+
+
+def benchmark_winograd(N=50, C=32, H=32, W=32, num_filters=32,
+                       dtype=np.float64, num_trials=3):
+    """
+    Compare the Winograd and stride-trick implementations of a 3x3 stride-1
+    convolution, checking both against conv_forward_naive / conv_backward_naive
+    and printing the time and the size of the cached columns for each.
+    """
+    x = np.random.randn(N, C, H, W).astype(dtype)
+    w = np.random.randn(num_filters, C, 3, 3).astype(dtype)
+    b = np.random.randn(num_filters).astype(dtype)
+    conv_param = {'stride': 1, 'pad': 1}
+
+    out_naive, cache_naive = conv_forward_naive(x, w, b, conv_param)
+    dout = np.random.randn(*out_naive.shape).astype(dtype)
+    dx_naive, dw_naive, db_naive = conv_backward_naive(dout, cache_naive)
+
+    for name, forward, backward in [
+            ('strides', conv_forward_strides, conv_backward_strides),
+            ('winograd', conv_forward_winograd, conv_backward_winograd)]:
+        t_forward, (out, cache) = time_function(
+            forward, x, w, b, conv_param, num_trials=num_trials)
+        t_backward, (dx, dw, db) = time_function(
+            backward, dout, cache, num_trials=num_trials)
+        print('Testing %s:' % name)
+        print('Forward: %fs' % t_forward)
+        print('Backward: %fs' % t_backward)
+        print('Cached columns: %.1fx the size of x' % (cache[-1].nbytes / x.nbytes))
+        print('out difference: ', rel_error(out_naive, out))
+        print('dx difference: ', rel_error(dx_naive, dx))
+        print('dw difference: ', rel_error(dw_naive, dw))
+        print('db difference: ', rel_error(db_naive, db))
+
+
+def col2im_add_at(cols, x_shape, field_height=3, field_width=3, padding=1,
+                  stride=1):
+    """
+    The original np.add.at implementation of col2im_indices, kept as a
+    reference for benchmark_col2im.
+    """
+    N, C, H, W = x_shape
+    H_padded, W_padded = H + 2 * padding, W + 2 * padding
+    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
+    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+                                 stride)
+    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
+    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
+    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+    if padding == 0:
+        return x_padded
+    return x_padded[:, :, padding:-padding, padding:-padding]
+
+
+def benchmark_col2im(N=50, C=16, H=32, W=32, dtype=np.float32, num_trials=3,
+                     params=((3, 1, 1), (3, 0, 1), (5, 2, 1), (2, 0, 2),
+                             (2, 1, 2), (4, 1, 2), (4, 0, 4))):
+    """
+    Time col2im_indices against the np.add.at reference for each
+    (field size, padding, stride) in params, checking that the results are
+    bit-identical. Combinations that do not fit the input size are skipped.
+    """
+    print('%-20s %10s %10s %8s %10s' % ('field/pad/stride', 'add.at',
+                                       'slices', 'speedup', 'identical'))
+    for field, pad, stride in params:
+        if (H + 2 * pad - field) % stride or (W + 2 * pad - field) % stride:
+            continue
+        out_h = (H + 2 * pad - field) // stride + 1
+        out_w = (W + 2 * pad - field) // stride + 1
+        cols = np.random.randn(C * field * field,
+                               out_h * out_w * N).astype(dtype)
+        x_shape = (N, C, H, W)
+        t_add_at, x_add_at = time_function(
+            col2im_add_at, cols, x_shape, field, field, pad, stride,
+            num_trials=num_trials)
+        t_slices, x_slices = time_function(
+            col2im_indices, cols, x_shape, field, field, pad, stride,
+            num_trials=num_trials)
+        print('%-20s %9.4fs %9.4fs %7.1fx %10s' % (
+            '%d/%d/%d' % (field, pad, stride), t_add_at, t_slices,
+            t_add_at / t_slices, np.array_equal(x_add_at, x_slices)))
+
+
+def cache_nbytes(cache, seen=None):
+    """
+    Total size in bytes of the arrays held (possibly nested) in a cache. An
+    array that is a view of another one in the cache is only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(cache, np.ndarray):
+        while isinstance(cache.base, np.ndarray):
+            cache = cache.base
+        if id(cache) in seen:
+            return 0
+        seen.add(id(cache))
+        return cache.nbytes
+    if isinstance(cache, (tuple, list)):
+        return sum(cache_nbytes(c, seen) for c in cache)
+    if isinstance(cache, dict):
+        return sum(cache_nbytes(c, seen) for c in cache.values())
+    return 0
+
+
+def calibrate_fft_crossover(channels=(3, 8, 16, 32), verbose=True, **kwargs):
+    """
+    Measure where the FFT convolution beats the stride-trick one on this
+    machine, and make conv_forward_fast use it for those layers only.
+
+    measure_fft_crossover (which takes the other keyword arguments) is run
+    for each input channel count in channels. fast_layers.fft_min_channels is
+    set to the smallest count from which the FFT method wins at that count and
+    every larger one, and fast_layers.fft_min_filter_size to the largest
+    filter size crossover over those counts. If the FFT method does not win
+    for the largest count, fft_min_filter_size is set to None, which turns
+    the FFT method off.
+
+    The crossover also moves with the batch size and the number of filters,
+    so these default to those of the default ThreeLayerConvNet (N=50,
+    num_filters=32); pass the shapes of the layers you train instead.
+
+    Returns the new (fft_min_channels, fft_min_filter_size).
+    """
+    kwargs.setdefault('N', 50)
+    kwargs.setdefault('num_filters', 32)
+    channels = sorted(channels)
+    crossovers = []
+    for C in channels:
+        if verbose:
+            print('C = %d' % C)
+        crossovers.append(measure_fft_crossover(C=C, verbose=verbose, **kwargs))
+
+    min_channels, min_filter_size = None, None
+    for C, crossover in reversed(list(zip(channels, crossovers))):
+        if crossover is None:
+            break
+        min_channels = C
+        min_filter_size = max(min_filter_size or 0, crossover)
+
+    if min_channels is not None:
+        fast_layers.fft_min_channels = min_channels
+    fast_layers.fft_min_filter_size = min_filter_size
+    if verbose:
+        print('fft_min_channels =', fast_layers.fft_min_channels)
+        print('fft_min_filter_size =', min_filter_size)
+    return fast_layers.fft_min_channels, min_filter_size
+
+
+def benchmark_conv_relu_pool(N=50, C=3, H=32, W=32, num_filters=32,
+                             filter_size=7, dtype=np.float32, num_trials=3):
+    """
+    Compare the fused conv_relu_pool_forward / conv_relu_pool_backward against
+    running the conv, ReLU and pool layers one after another, printing the time
+    and the cache size of each and checking that the results agree.
+    """
+    x = np.random.randn(N, C, H, W).astype(dtype)
+    w = np.random.randn(num_filters, C, filter_size, filter_size).astype(dtype)
+    b = np.random.randn(num_filters).astype(dtype)
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    def separate_forward(x, w, b):
+        a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+        s, relu_cache = relu_forward(a)
+        out, pool_cache = max_pool_forward_fast(s, pool_param)
+        return out, (conv_cache, relu_cache, pool_cache)
+
+    def separate_backward(dout, cache):
+        conv_cache, relu_cache, pool_cache = cache
+        ds = max_pool_backward_fast(dout, pool_cache)
+        da = relu_backward(ds, relu_cache)
+        return conv_backward_fast(da, conv_cache)
+
+    t_forward, (out, cache) = time_function(separate_forward, x, w, b,
+                                            num_trials=num_trials)
+    dout = np.random.randn(*out.shape).astype(dtype)
+    t_backward, grads = time_function(separate_backward, dout, cache,
+                                      num_trials=num_trials)
+    nbytes = cache_nbytes(cache)
+
+    t_fused_forward, (out_fused, cache_fused) = time_function(
+        conv_relu_pool_forward, x, w, b, conv_param, pool_param,
+        num_trials=num_trials)
+    t_fused_backward, grads_fused = time_function(
+        conv_relu_pool_backward, dout, cache_fused, num_trials=num_trials)
+    nbytes_fused = cache_nbytes(cache_fused)
+
+    print('%-10s %10s %10s %12s' % ('', 'forward', 'backward', 'cache MB'))
+    print('%-10s %9.4fs %9.4fs %12.1f' % ('separate', t_forward, t_backward,
+                                          nbytes / 2.0 ** 20))
+    print('%-10s %9.4fs %9.4fs %12.1f' % ('fused', t_fused_forward,
+                                          t_fused_backward,
+                                          nbytes_fused / 2.0 ** 20))
+    print('out difference: ', rel_error(out, out_fused))
+    for name, g, g_fused in zip(('dx', 'dw', 'db'), grads, grads_fused):
+        print('%s difference: ' % name, rel_error(g, g_fused))
+
+
+def benchmark_max_pool(N=50, C=64, H=32, W=32, dtype=np.float32,
+                       num_trials=3):
+    """
+    Time max_pool_forward_fast / max_pool_backward_fast for tiling, overlapping
+    and padded pooling windows, printing which method each one used and the
+    size of its cache, and check the results against the naive implementation
+    on the first two examples. The tiling 2x2 pool is run both with the
+    reshape method and with pool_param['argmax'] set.
+    """
+    x = np.random.randn(N, C, H, W).astype(dtype)
+    configs = [(2, 2, 0, False), (2, 2, 0, True), (3, 2, 0, False),
+               (3, 2, 1, False), (3, 1, 1, False)]
+
+    print('%-16s %8s %10s %10s %10s %14s' % ('pool', 'method', 'forward',
+                                             'backward', 'cache MB',
+                                             'dx difference'))
+    for size, stride, pad, argmax in configs:
+        pool_param = {'pool_height': size, 'pool_width': size,
+                      'stride': stride, 'pad': pad, 'argmax': argmax}
+        t_forward, (out, cache) = time_function(
+            max_pool_forward_fast, x, pool_param, num_trials=num_trials)
+        dout = np.random.randn(*out.shape).astype(dtype)
+        t_backward, dx = time_function(
+            max_pool_backward_fast, dout, cache, num_trials=num_trials)
+
+        out_naive, cache_naive = max_pool_forward_naive(x[:2], pool_param)
+        dx_naive = max_pool_backward_naive(dout[:2], cache_naive)
+        assert np.allclose(out[:2], out_naive)
+
+        name = '%dx%d/%d pad %d' % (size, size, stride, pad)
+        print('%-16s %8s %9.4fs %9.4fs %10.1f %14e' % (
+            name, cache[0], t_forward, t_backward,
+            cache_nbytes(cache) / 2.0 ** 20, rel_error(dx[:2], dx_naive)))
+
+
+def benchmark_recompute(N=50, C=16, H=32, W=32, num_filters=32, filter_size=3,
+                        dtype=np.float32, num_trials=3):
+    """
+    Compare each convolution method that supports recompute mode with and
+    without it, printing the forward and backward time and the cache size.
+    """
+    x = np.random.randn(N, C, H, W).astype(dtype)
+    w = np.random.randn(num_filters, C, filter_size, filter_size).astype(dtype)
+    b = np.random.randn(num_filters).astype(dtype)
+
+    print('%-20s %10s %10s %12s' % ('', 'forward', 'backward', 'cache MB'))
+    for name in ('im2col', 'strides'):
+        forward, backward = CONV_METHODS[name]
+        for recompute in (False, True):
+            conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                          'recompute': recompute}
+            t_forward, (out, cache) = time_function(
+                forward, x, w, b, conv_param, num_trials=num_trials)
+            dout = np.random.randn(*out.shape).astype(dtype)
+            t_backward, _ = time_function(backward, dout, cache,
+                                          num_trials=num_trials)
+            label = name + (' (recompute)' if recompute else '')
+            print('%-20s %9.4fs %9.4fs %12.1f' % (
+                label, t_forward, t_backward, cache_nbytes(cache) / 2.0 ** 20))
+
+
+def benchmark_tiled(batch_sizes=(25, 50, 100, 200), C=16, H=32, W=32,
+                    num_filters=32, filter_size=3, dtype=np.float32,
+                    num_trials=2):
+    """
+    Compare the stride-trick and tiled convolutions as the batch grows,
+    printing the time for a forward and backward pass and the peak memory
+    allocated during it.
+    """
+    import tracemalloc
+
+    def forward_backward(forward, backward, x, w, b, conv_param):
+        out, cache = forward(x, w, b, conv_param)
+        return backward(out, cache)
+
+    w = np.random.randn(num_filters, C, filter_size, filter_size).astype(dtype)
+    b = np.random.randn(num_filters).astype(dtype)
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+
+    print('%-8s %-8s %10s %10s' % ('N', 'method', 'time', 'peak MB'))
+    for N in batch_sizes:
+        x = np.random.randn(N, C, H, W).astype(dtype)
+        for name in ('strides', 'tiled'):
+            forward, backward = CONV_METHODS[name]
+            t, _ = time_function(forward_backward, forward, backward, x, w, b,
+                                 conv_param, num_trials=num_trials)
+            tracemalloc.start()
+            forward_backward(forward, backward, x, w, b, conv_param)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('%-8d %-8s %9.4fs %10.1f' % (N, name, t, peak / 2.0 ** 20))
+
+
+def benchmark_workspace(num_train=500, batch_size=50, num_epochs=2,
+                        filter_size=3, dtype=np.float32):
+    """
+    Train a ThreeLayerConvNet on random data with and without a workspace,
+    printing the training time and, for the workspace, how many bytes of
+    scratch buffers were allocated and how many were reused. (The FFT
+    convolution does not use the workspace, so the default filter size is one
+    that conv_forward_fast computes with stride tricks.)
+    """
+    from cs231n.classifiers.cnn import ThreeLayerConvNet
+    from cs231n.solver import Solver
+
+    data = {
+        'X_train': np.random.randn(num_train, 3, 32, 32).astype(dtype),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(batch_size, 3, 32, 32).astype(dtype),
+        'y_val': np.random.randint(10, size=batch_size),
+    }
+    for use_workspace in (False, True):
+        np.random.seed(0)
+        model = ThreeLayerConvNet(filter_size=filter_size, dtype=dtype)
+        solver = Solver(model, data, num_epochs=num_epochs,
+                        batch_size=batch_size, num_train_samples=batch_size,
+                        verbose=False, use_workspace=use_workspace)
+        t0 = time()
+        solver.train()
+        t1 = time()
+        print('use_workspace=%s: %.2fs' % (use_workspace, t1 - t0))
+        if use_workspace:
+            stats = solver.workspace.stats()
+            print('allocated %.1f MB in %d buffers, reused %.1f MB in %d' % (
+                stats['bytes_allocated'] / 2.0 ** 20, stats['num_allocated'],
+                stats['bytes_reused'] / 2.0 ** 20, stats['num_reused']))
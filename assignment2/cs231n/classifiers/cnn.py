@@ -14,12 +14,25 @@ class ThreeLayerConvNet(object):
 
     The network operates on minibatches of data that have shape (N, C, H, W)
     consisting of N images, each with height H and width W and with C input
-    channels.
+    channels. Pass layout='NHWC' to work on channels-last data of shape
+    (N, H, W, C) instead.
+
+    With global_pool=True the max pool is replaced by a global average pool:
+
+    conv - relu - global avg pool - affine - relu - affine - softmax
+
+    so that the hidden affine layer sees num_filters features rather than
+    num_filters * H * W / 4, which makes W2 and its matrix multiply far
+    smaller.
+
+    As in FullyConnectedNet, output='sampled' or output='hierarchical' trains
+    the output layer without scoring every example against every class.
     """
 
     def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                  hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-                 dtype=np.float32):
+                 dtype=np.float32, layout='NCHW', recompute=False,
+                 global_pool=False, output='softmax', output_param=None):
         """
         Initialize a new network.
 
@@ -33,10 +46,25 @@ class ThreeLayerConvNet(object):
           of weights.
         - reg: Scalar giving L2 regularization strength
         - dtype: numpy datatype to use for computation.
+        - layout: 'NCHW' or 'NHWC'; the memory layout of the input data and of
+          the activations inside the network. input_dim is always (C, H, W).
+        - recompute: If True the convolutional layer keeps only its input for
+          the backward pass and rebuilds its im2col columns there, trading
+          some speed for a much smaller cache.
+        - global_pool: If True, use a global average pool after the
+          convolutional layer instead of the 2x2 max pool.
+        - output, output_param: 'softmax', 'sampled' or 'hierarchical', and the
+          options for it; see FullyConnectedNet. The hierarchical softmax keeps
+          its cluster weights in Wc and bc.
         """
         self.params = {}
         self.reg = reg
         self.dtype = dtype
+        self.layout = layout
+        self.recompute = recompute
+        self.global_pool = global_pool
+        self.output = output
+        self.output_param = dict(output_param or {})
 
         ############################################################################
         # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -68,12 +96,26 @@ class ThreeLayerConvNet(object):
         self.params['b1'] = np.zeros(num_filters)
         
         # Hidden Affine Layer
+        if global_pool:
+            HPP, WPP = 1, 1
         self.params['W2'] = weight_scale * np.random.randn(num_filters * HPP * WPP, hidden_dim)
         self.params['b2'] = np.zeros(hidden_dim)
         
         # Output Affine Layer
         self.params['W3'] = weight_scale * np.random.randn(hidden_dim, num_classes)
         self.params['b3'] = np.zeros(num_classes)
+        if output == 'sampled':
+            self.output_param.setdefault('num_sampled', 64)
+        elif output == 'hierarchical':
+            num_clusters = self.output_param.get(
+                'num_clusters', int(np.ceil(np.sqrt(num_classes))))
+            # Drop clusters that would be left without any classes
+            cluster_size = -(-num_classes // num_clusters)
+            num_clusters = -(-num_classes // cluster_size)
+            self.params['Wc'] = weight_scale * np.random.randn(hidden_dim, num_clusters)
+            self.params['bc'] = np.zeros(num_clusters)
+        elif output != 'softmax':
+            raise ValueError('Unrecognized output "%s"' % output)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -94,10 +136,12 @@ class ThreeLayerConvNet(object):
 
         # pass conv_param to the forward pass for the convolutional layer
         filter_size = W1.shape[2]
-        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                      'layout': self.layout, 'recompute': self.recompute}
 
         # pass pool_param to the forward pass for the max-pooling layer
-        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                      'layout': self.layout}
 
         scores = None
         ############################################################################
@@ -108,16 +152,27 @@ class ThreeLayerConvNet(object):
         cache = []
         
         # Forward 1) conv - relu - pool
-        dx, local_cache = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
-        cache.append(local_cache)
+        if self.global_pool:
+            dx, local_cache = conv_relu_forward(X, W1, b1, conv_param)
+            cache.append(local_cache)
+            dx, local_cache = global_avg_pool_forward(dx, pool_param)
+            cache.append(local_cache)
+        else:
+            dx, local_cache = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+            cache.append(local_cache)
         
         # Forward 2) affine - relu
         dx, local_cache = affine_relu_forward(dx, W2, b2)
         cache.append(local_cache)
         
-        # Forward 3) final affine
-        scores, local_cache = affine_forward(dx, W3, b3)
-        cache.append(local_cache)
+        # Forward 3) final affine, which the sampled and hierarchical outputs
+        # only compute over all classes in test mode
+        if self.output == 'hierarchical' and y is None:
+            scores = hierarchical_softmax_scores(dx, W3, b3, self.params['Wc'],
+                                                 self.params['bc'])
+        elif self.output == 'softmax' or y is None:
+            scores, local_cache = affine_forward(dx, W3, b3)
+            cache.append(local_cache)
         
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -134,13 +189,21 @@ class ThreeLayerConvNet(object):
         # for self.params[k]. Don't forget to add L2 regularization!               #
         ############################################################################
         
-        # Forward & Backward 4) Softmax
-        data_loss, dL = softmax_loss(scores, y) 
+        # Forward & Backward 4) Softmax, and Backward 3) final affine
         reg_loss = 0.5 * self.reg * ( np.sum( W1**2) + np.sum( W2**2) + np.sum( W3**2) )
+        if self.output == 'sampled':
+            data_loss, dx, dW, db = sampled_softmax_loss(dx, W3, b3, y, self.output_param)
+        elif self.output == 'hierarchical':
+            Wc, bc = self.params['Wc'], self.params['bc']
+            data_loss, dx, dW, db, dWc, dbc = hierarchical_softmax_loss(dx, W3, b3, Wc, bc, y)
+            grads['Wc'] = dWc + self.reg*Wc
+            grads['bc'] = dbc
+            reg_loss += 0.5 * self.reg * np.sum( Wc**2)
+        else:
+            data_loss, dL = softmax_loss(scores, y) 
+            dx, dW, db = affine_backward(dL, cache.pop())
         loss = data_loss + reg_loss
         
-        # Backward 3) final affine
-        dx, dW, db = affine_backward(dL, cache.pop())
         grads['W3'] = dW + self.reg*self.params['W3']
         grads['b3'] = db
         
@@ -150,7 +213,11 @@ class ThreeLayerConvNet(object):
         grads['b2'] = db
         
         # Backward 1) conv - relu - pool
-        dx, dW, db = conv_relu_pool_backward(dx, cache.pop())
+        if self.global_pool:
+            dx = global_avg_pool_backward(dx, cache.pop())
+            dx, dW, db = conv_relu_backward(dx, cache.pop())
+        else:
+            dx, dW, db = conv_relu_pool_backward(dx, cache.pop())
         grads['W1'] = dW + self.reg*self.params['W1']
         grads['b1'] = db
         
@@ -1,5 +1,7 @@
 from builtins import range
 from builtins import object
+import copy
+
 import numpy as np
 
 from cs231n.layers import *
@@ -140,13 +142,21 @@ class FullyConnectedNet(object):
     where batch normalization and dropout are optional, and the {...} block is
     repeated L - 1 times.
 
+    For many classes the final affine - softmax can be trained with a sampled
+    softmax, or replaced by a two-level hierarchical softmax, so that a
+    training step does not score every example against every class; see the
+    output argument. The gradient and update of the full output weights still
+    cost time linear in the number of classes. Test-time scores are always
+    computed over all classes.
+
     Similar to the TwoLayerNet above, learnable parameters are stored in the
     self.params dictionary and will be learned using the Solver class.
     """
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0, use_batchnorm=False, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None,
+                 regenerate_dropout=False, output='softmax', output_param=None):
         """
         Initialize a new FullyConnectedNet.
 
@@ -166,12 +176,28 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - regenerate_dropout: If True, the dropout layers redraw their masks in
+          the backward pass from the seed used in the forward pass, instead of
+          keeping them (bit-packed) in the cache.
+        - output: How the training loss treats the output layer. One of
+          'softmax': the final affine layer and softmax_loss over all classes;
+          'sampled': the same layer, trained with sampled_softmax_loss;
+          'hierarchical': a hierarchical softmax, with cluster weights Wc and
+          bc next to the final W and b, trained with hierarchical_softmax_loss.
+          In test mode the sampled model returns the full affine scores and the
+          hierarchical one the exact log-probabilities of all classes.
+        - output_param: Dictionary of options for the output layer. For
+          'sampled' it is the sample_param of sampled_softmax_loss, where
+          num_sampled defaults to 64; for 'hierarchical' its num_clusters key
+          gives the number of clusters, by default about sqrt(num_classes).
         """
         self.use_batchnorm = use_batchnorm
         self.use_dropout = dropout > 0
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
+        self.output = output
+        self.output_param = dict(output_param or {})
         self.params = {}
 
         ############################################################################
@@ -197,6 +223,20 @@ class FullyConnectedNet(object):
             if self.use_batchnorm and i < len(dims) - 2:
                 self.params['gamma' + str(i+1)] = np.ones(dims[i+1])
                 self.params['beta' + str(i+1)] = np.zeros(dims[i+1])
+
+        # Output layer
+        if output == 'sampled':
+            self.output_param.setdefault('num_sampled', 64)
+        elif output == 'hierarchical':
+            num_clusters = self.output_param.get(
+                'num_clusters', int(np.ceil(np.sqrt(num_classes))))
+            # Drop clusters that would be left without any classes
+            cluster_size = -(-num_classes // num_clusters)
+            num_clusters = -(-num_classes // cluster_size)
+            self.params['Wc'] = weight_scale * np.random.randn(dims[-2], num_clusters)
+            self.params['bc'] = np.zeros(num_clusters)
+        elif output != 'softmax':
+            raise ValueError('Unrecognized output "%s"' % output)
         
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -204,12 +244,16 @@ class FullyConnectedNet(object):
 
         # When using dropout we need to pass a dropout_param dictionary to each
         # dropout layer so that the layer knows the dropout probability and the mode
-        # (train / test). You can pass the same dropout_param to each dropout layer.
-        self.dropout_param = {}
+        # (train / test). Each layer gets its own dropout_param, and so its own
+        # stream of random masks.
+        self.dropout_params = []
         if self.use_dropout:
-            self.dropout_param = {'mode': 'train', 'p': dropout}
+            self.dropout_params = [{'mode': 'train', 'p': dropout,
+                                    'regenerate': regenerate_dropout}
+                                   for i in range(self.num_layers - 1)]
             if seed is not None:
-                self.dropout_param['seed'] = seed
+                for i, dropout_param in enumerate(self.dropout_params):
+                    dropout_param['seed'] = seed + i
 
         # With batch normalization we need to keep track of running means and
         # variances, so we need to pass a special bn_param object to each batch
@@ -237,7 +281,8 @@ class FullyConnectedNet(object):
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
         if self.use_dropout:
-            self.dropout_param['mode'] = mode
+            for dropout_param in self.dropout_params:
+                dropout_param['mode'] = mode
         if self.use_batchnorm:
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
@@ -247,7 +292,7 @@ class FullyConnectedNet(object):
         # TODO: Implement the forward pass for the fully-connected net, computing  #
         # the class scores for X and storing them in the scores variable.          #
         #                                                                          #
-        # When using dropout, you'll need to pass self.dropout_param to each       #
+        # When using dropout, you'll need to pass self.dropout_params[i] to each   #
         # dropout forward pass.                                                    #
         #                                                                          #
         # When using batch normalization, you'll need to pass self.bn_params[0] to #
@@ -274,17 +319,24 @@ class FullyConnectedNet(object):
                 cache.append(local_cache)
             
             # ReLU
-            x, local_cache = relu_forward(x)
+            x, local_cache = relu_forward(x, inplace=True)
             cache.append(local_cache)
             
             # Dropout
             if self.use_dropout:
-                x, local_cache = dropout_forward(x, self.dropout_param)
+                x, local_cache = dropout_forward(x, self.dropout_params[i])
                 cache.append(local_cache)
                 
-        # Final Affine Layer
-        scores, local_cache = affine_forward(x, self.params['W' + str(self.num_layers)], self.params['b' + str(self.num_layers)])
-        cache.append(local_cache)
+        # Final Affine Layer. The sampled and hierarchical outputs only score
+        # x against all the classes in test mode; in training their losses
+        # below take x itself.
+        W, b = self.params['W' + str(self.num_layers)], self.params['b' + str(self.num_layers)]
+        x = x.reshape(x.shape[0], -1)
+        if self.output == 'hierarchical' and mode == 'test':
+            scores = hierarchical_softmax_scores(x, W, b, self.params['Wc'], self.params['bc'])
+        elif self.output == 'softmax' or mode == 'test':
+            scores, local_cache = affine_forward(x, W, b)
+            cache.append(local_cache)
         
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -310,16 +362,23 @@ class FullyConnectedNet(object):
         ############################################################################
         N = X.shape[0]
         
-        # Loss
-        data_loss, dx = softmax_loss(scores, y) 
+        # Loss and Backward Pass of the Final Layer
         reg_loss = 0
+        if self.output == 'sampled':
+            data_loss, dx, dW, db = sampled_softmax_loss(x, W, b, y, self.output_param)
+        elif self.output == 'hierarchical':
+            Wc, bc = self.params['Wc'], self.params['bc']
+            data_loss, dx, dW, db, dWc, dbc = hierarchical_softmax_loss(x, W, b, Wc, bc, y)
+            grads['Wc'] = dWc + self.reg*Wc
+            grads['bc'] = dbc
+            reg_loss += np.sum(Wc**2)
+        else:
+            data_loss, dx = softmax_loss(scores, y) 
+            dx, dW, db = affine_backward(dx, cache.pop()) # Final Affine Layer
         for i in range(self.num_layers):
             reg_loss += np.sum( self.params['W'+str(i+1)]**2)
         loss = data_loss + 0.5*self.reg*reg_loss
         
-        # Backward Pass
-        dx, dW, db = affine_backward(dx, cache.pop()) # Final Affine Layer
-        
         grads['W'+str(self.num_layers)] = dW + self.reg*self.params['W'+str(self.num_layers)]
         grads['b'+str(self.num_layers)] = db
 
@@ -334,7 +393,7 @@ class FullyConnectedNet(object):
             
             # Batch Normalization
             if self.use_batchnorm: 
-                dx, dgamma, dbeta = batchnorm_backward(dx, cache.pop())
+                dx, dgamma, dbeta = batchnorm_backward_alt(dx, cache.pop())
             
             # Affine
             dx, dW, db = affine_backward(dx, cache.pop())
@@ -350,3 +409,34 @@ class FullyConnectedNet(object):
         ############################################################################
 
         return loss, grads
+
+
+    def fold_batchnorm(self):
+        """
+        Build a copy of this network for inference in which every batchnorm
+        layer has been folded into the affine layer before it with
+        batchnorm_fold, using the running averages collected in training.
+
+        The copy computes the same scores as self.loss(X) in test mode, but
+        runs one affine layer and one ReLU per hidden layer instead of an
+        affine layer, a batchnorm layer and a ReLU. It has no gamma or beta
+        parameters, so it should not be trained further.
+        """
+        model = copy.deepcopy(self)
+        if not self.use_batchnorm:
+            return model
+
+        for i, bn_param in enumerate(self.bn_params):
+            layer = str(i + 1)
+            w, b = batchnorm_fold(self.params['W' + layer],
+                                  self.params['b' + layer],
+                                  self.params['gamma' + layer],
+                                  self.params['beta' + layer], bn_param)
+            model.params['W' + layer] = w.astype(self.dtype)
+            model.params['b' + layer] = b.astype(self.dtype)
+            del model.params['gamma' + layer]
+            del model.params['beta' + layer]
+
+        model.use_batchnorm = False
+        model.bn_params = []
+        return model
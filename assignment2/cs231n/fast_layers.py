@@ -1,14 +1,33 @@
 from __future__ import print_function
+import json
+import os
+
 import numpy as np
 try:
     from cs231n.im2col_cython import col2im_cython, im2col_cython
     from cs231n.im2col_cython import col2im_6d_cython
+    im2col_backend = 'cython'
 except ImportError:
-    print('run the following from the cs231n directory and try again:')
-    print('python setup.py build_ext --inplace')
-    print('You may also need to restart your iPython kernel')
+    im2col_backend = 'numpy'
 
 from cs231n.im2col import *
+from cs231n import workspace
+from cs231n.layers import conv_forward_naive, conv_forward_naive2
+from cs231n.layers import conv_backward_naive
+from cs231n.layers import conv_forward_grouped_naive, conv_backward_grouped_naive
+
+# Pick the im2col / col2im kernels once at import time. The Cython extension is
+# used when it has been built (python setup.py build_ext --inplace from the
+# cs231n directory); otherwise we fall back on the vectorized NumPy versions,
+# which are slower but need no compiled code.
+if im2col_backend == 'cython':
+    im2col_fast = im2col_cython
+    col2im_fast = col2im_cython
+    col2im_6d_fast = col2im_6d_cython
+else:
+    im2col_fast = im2col_indices
+    col2im_fast = col2im_numpy
+    col2im_6d_fast = col2im_6d_numpy
 
 
 def conv_forward_im2col(x, w, b, conv_param):
@@ -19,54 +38,114 @@ def conv_forward_im2col(x, w, b, conv_param):
     N, C, H, W = x.shape
     num_filters, _, filter_height, filter_width = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
+    dilation = conv_param.get('dilation', 1)
+    span_height = dilation * (filter_height - 1) + 1
+    span_width = dilation * (filter_width - 1) + 1
 
     # Check dimensions
-    assert (W + 2 * pad - filter_width) % stride == 0, 'width does not work'
-    assert (H + 2 * pad - filter_height) % stride == 0, 'height does not work'
+    assert (W + 2 * pad - span_width) % stride == 0, 'width does not work'
+    assert (H + 2 * pad - span_height) % stride == 0, 'height does not work'
 
     # Create output
-    out_height = (H + 2 * pad - filter_height) // stride + 1
-    out_width = (W + 2 * pad - filter_width) // stride + 1
+    out_height = (H + 2 * pad - span_height) // stride + 1
+    out_width = (W + 2 * pad - span_width) // stride + 1
     out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
     # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-    x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
+    x_cols = workspace.empty((C * filter_height * filter_width,
+                              out_height * out_width * N), x.dtype)
+    x_cols = im2col_fast(x, w.shape[2], w.shape[3], pad, stride, dilation,
+                         out=x_cols)
     res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
 
     out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
     out = out.transpose(3, 0, 1, 2)
 
+    # In recompute mode the backward pass rebuilds the columns from x
+    if conv_param.get('recompute', False):
+        workspace.release(x_cols)
+        x_cols = None
+
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def _pad_input(x, pad_width):
+    """
+    Zero-pad x, as np.pad(x, pad_width, mode='constant') would, but into a
+    buffer from the workspace: x is copied into its interior and only the
+    border is zeroed, rather than zeroing the whole array first. Callers hand
+    the buffer back with workspace.release once they are done with it. When
+    there is no padding x itself is returned, with no copy at all.
+    """
+    if not any(before or after for before, after in pad_width):
+        return x
+    shape = tuple(n + before + after
+                  for n, (before, after) in zip(x.shape, pad_width))
+    x_padded = workspace.empty(shape, x.dtype)
+    interior = tuple(slice(before, before + n)
+                     for n, (before, _) in zip(x.shape, pad_width))
+    x_padded[interior] = x
+
+    # Zero the slabs before and after the interior along each padded axis
+    for axis, (before, after) in enumerate(pad_width):
+        border = [slice(None)] * x.ndim
+        if before:
+            border[axis] = slice(0, before)
+            x_padded[tuple(border)] = 0
+        if after:
+            border[axis] = slice(shape[axis] - after, shape[axis])
+            x_padded[tuple(border)] = 0
+    return x_padded
+
+
+def _im2col_strides(x, HH, WW, conv_param, out=None):
+    """
+    im2col for an NCHW input using stride tricks. Returns the columns, of
+    shape (C * HH * WW, N * out_h * out_w), along with out_h and out_w. If out
+    is given the columns are written into it rather than a new array; it must
+    be a contiguous array with at least that many elements. Otherwise they go
+    in a buffer from the workspace.
+    """
     N, C, H, W = x.shape
-    F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
 
     # Check dimensions
     #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
     #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
-    # Pad the input
-    p = pad
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
     # Figure out output dimensions
-    H += 2 * pad
-    W += 2 * pad
-    out_h = (H - HH) // stride + 1
-    out_w = (W - WW) // stride + 1
+    out_h = (H + 2 * pad - d * (HH - 1) - 1) // stride + 1
+    out_w = (W + 2 * pad - d * (WW - 1) - 1) // stride + 1
 
-    # Perform an im2col operation by picking clever strides
     shape = (C, HH, WW, N, out_h, out_w)
-    strides = (H * W, W, 1, C * H * W, stride * W, stride)
-    strides = x.itemsize * np.array(strides)
+    size = C * HH * WW * N * out_h * out_w
+    if out is None:
+        out = workspace.empty(size, x.dtype)
+    x_cols = out.ravel()[:size].reshape(shape)
+
+    # Perform an im2col operation by picking clever strides; with dilation d
+    # adjacent filter taps are d pixels apart
+    x_padded = _pad_input(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)))
+    sN, sC, sH, sW = x_padded.strides
+    strides = (sC, d * sH, d * sW, sN, stride * sH, stride * sW)
     x_stride = np.lib.stride_tricks.as_strided(x_padded,
                   shape=shape, strides=strides)
-    x_cols = np.ascontiguousarray(x_stride)
+    np.copyto(x_cols, x_stride)
+    if x_padded is not x:
+        workspace.release(x_padded)
     x_cols.shape = (C * HH * WW, N * out_h * out_w)
+    return x_cols, out_h, out_w
+
+
+def conv_forward_strides(x, w, b, conv_param):
+    if conv_param.get('layout', 'NCHW') == 'NHWC':
+        return conv_forward_strides_nhwc(x, w, b, conv_param)
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    x_cols, out_h, out_w = _im2col_strides(x, HH, WW, conv_param)
 
     # Now all our convolutions are a big matrix multiply
     res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
@@ -80,12 +159,19 @@ def conv_forward_strides(x, w, b, conv_param):
     # comparison we won't either
     out = np.ascontiguousarray(out)
 
+    # In recompute mode the backward pass rebuilds the columns from x
+    if conv_param.get('recompute', False):
+        workspace.release(x_cols)
+        x_cols = None
+
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
 
 
 def conv_backward_strides(dout, cache):
     x, w, b, conv_param, x_cols = cache
+    if conv_param.get('layout', 'NCHW') == 'NHWC':
+        return conv_backward_strides_nhwc(dout, cache)
     stride, pad = conv_param['stride'], conv_param['pad']
 
     N, C, H, W = x.shape
@@ -94,12 +180,220 @@ def conv_backward_strides(dout, cache):
 
     db = np.sum(dout, axis=(0, 2, 3))
 
+    if x_cols is None:
+        x_cols, _, _ = _im2col_strides(x, HH, WW, conv_param)
     dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
     dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
+    dtype = np.result_type(w, dout)
+    dx_cols = workspace.empty((C * HH * WW, N * out_h * out_w), dtype)
+    np.dot(w.reshape(F, -1).T, dout_reshaped, out=dx_cols)
     dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+    dx_padded = workspace.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype)
+    dx = col2im_6d_fast(dx_cols, N, C, H, W, HH, WW, pad, stride,
+                        conv_param.get('dilation', 1), out=dx_padded)
+    workspace.release(dx_cols)
+
+    return dx, dw, db
+
+
+# Default scratch budget in bytes for the im2col columns of one tile in
+# conv_forward_tiled, used when conv_param has no 'scratch_bytes'.
+conv_scratch_bytes = 16 * 2 ** 20
+
+
+def _conv_tile_size(x, w, conv_param):
+    """
+    The number of images per tile for conv_forward_tiled: as many as fit in
+    the scratch budget, but at least one.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+    out_h = (H + 2 * pad - d * (HH - 1) - 1) // stride + 1
+    out_w = (W + 2 * pad - d * (WW - 1) - 1) // stride + 1
+    image_bytes = C * HH * WW * out_h * out_w * x.itemsize
+    budget = conv_param.get('scratch_bytes', conv_scratch_bytes)
+    return int(min(N, max(1, budget // image_bytes)))
+
+
+def conv_forward_tiled(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer that
+    bounds its scratch memory.
+
+    conv_forward_strides builds the im2col columns for the whole minibatch at
+    once, so its peak memory grows with the batch size. Here we instead work
+    through the minibatch a tile of images at a time, where a tile holds as
+    many images as fit in conv_param['scratch_bytes'] (conv_scratch_bytes by
+    default) of columns. The columns for every tile are written into one
+    preallocated buffer, so memory stays flat as the batch grows. Nothing but
+    x is cached; the backward pass rebuilds the columns tile by tile.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    tile = _conv_tile_size(x, w, conv_param)
+
+    w_cols = w.reshape(F, -1)
+    x_cols = None
+    out = None
+    for n in range(0, N, tile):
+        x_tile = x[n:n + tile]
+        if x_cols is None:
+            x_cols, out_h, out_w = _im2col_strides(x_tile, HH, WW, conv_param)
+            out = np.empty((N, F, out_h, out_w), dtype=x.dtype)
+        else:
+            x_cols, _, _ = _im2col_strides(x_tile, HH, WW, conv_param,
+                                           out=x_cols)
+        res = w_cols.dot(x_cols) + b.reshape(-1, 1)
+        res.shape = (F, x_tile.shape[0], out_h, out_w)
+        out[n:n + tile] = res.transpose(1, 0, 2, 3)
+    workspace.release(x_cols)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_tiled(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_tiled.
+    """
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+    tile = _conv_tile_size(x, w, conv_param)
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    w_cols = w.reshape(F, -1)
+    dw = np.zeros_like(w_cols)
+    dtype = np.result_type(w, dout)
+    dx = np.empty(x.shape, dtype=dtype)
+    x_cols = dx_buffer = None
+    for n in range(0, N, tile):
+        x_tile = x[n:n + tile]
+        x_cols, _, _ = _im2col_strides(x_tile, HH, WW, conv_param, out=x_cols)
+        dout_reshaped = dout[n:n + tile].transpose(1, 0, 2, 3).reshape(F, -1)
+        dw += dout_reshaped.dot(x_cols.T)
+
+        # The columns of dx for this tile reuse the x_cols buffer when it has
+        # the dtype of the product, and otherwise a buffer of their own. The
+        # first tile is the largest, so later tiles use part of the buffer.
+        if dx_buffer is None:
+            if x_cols.dtype == dtype:
+                dx_buffer = x_cols
+            else:
+                dx_buffer = workspace.empty(x_cols.shape, dtype)
+        dx_cols = dx_buffer.reshape(-1)[:x_cols.size].reshape(x_cols.shape)
+        np.dot(w_cols.T, dout_reshaped, out=dx_cols)
+        dx_cols.shape = (C, HH, WW, x_tile.shape[0], out_h, out_w)
+        dx[n:n + tile] = col2im_6d_fast(dx_cols, x_tile.shape[0], C, H, W, HH,
+                                        WW, pad, stride, d)
+    workspace.release(x_cols)
+    if dx_buffer is not x_cols:
+        workspace.release(dx_buffer)
+
+    return dx, dw.reshape(w.shape), db
+
+
+def _im2col_strides_nhwc(x, HH, WW, conv_param):
+    """
+    im2col for an NHWC input using stride tricks. Returns the columns, of
+    shape (N * out_h * out_w, HH * WW * C), along with out_h and out_w. The
+    columns go in a buffer from the workspace.
+    """
+    N, H, W, C = x.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+
+    # Figure out output dimensions
+    out_h = (H + 2 * pad - d * (HH - 1) - 1) // stride + 1
+    out_w = (W + 2 * pad - d * (WW - 1) - 1) // stride + 1
+
+    shape = (N, out_h, out_w, HH, WW, C)
+    x_cols = workspace.empty(shape, x.dtype)
+
+    # Perform an im2col operation by picking clever strides
+    x_padded = _pad_input(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+    sN, sH, sW, sC = x_padded.strides
+    strides = (sN, stride * sH, stride * sW, d * sH, d * sW, sC)
+    x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                  shape=shape, strides=strides)
+    np.copyto(x_cols, x_stride)
+    if x_padded is not x:
+        workspace.release(x_padded)
+    x_cols.shape = (N * out_h * out_w, HH * WW * C)
+    return x_cols, out_h, out_w
+
+
+def conv_forward_strides_nhwc(x, w, b, conv_param):
+    """
+    Channels-last version of conv_forward_strides.
+
+    The input x has shape (N, H, W, C) and the output has shape
+    (N, H', W', F); the filters w keep their usual (F, C, HH, WW) shape. The
+    columns are laid out as (N * H' * W', HH * WW * C) so the matrix multiply
+    produces the output directly in its final layout, with no transpose copy.
+    """
+    N, H, W, C = x.shape
+    F, _, HH, WW = w.shape
+    x_cols, out_h, out_w = _im2col_strides_nhwc(x, HH, WW, conv_param)
+
+    w_cols = w.transpose(2, 3, 1, 0).reshape(-1, F)
+    res = x_cols.dot(w_cols) + b
+    out = res.reshape(N, out_h, out_w, F)
+
+    # In recompute mode the backward pass rebuilds the columns from x
+    if conv_param.get('recompute', False):
+        workspace.release(x_cols)
+        x_cols = None
+
+    cache = (x, w, b, conv_param, x_cols)
+    return out, cache
+
+
+def conv_backward_strides_nhwc(dout, cache):
+    """
+    Channels-last version of conv_backward_strides; dout has shape
+    (N, H', W', F) and dx has shape (N, H, W, C).
+    """
+    x, w, b, conv_param, x_cols = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+
+    N, H, W, C = x.shape
+    F, _, HH, WW = w.shape
+    _, out_h, out_w, _ = dout.shape
+
+    dout_reshaped = dout.reshape(-1, F)
+    db = np.sum(dout_reshaped, axis=0)
+
+    if x_cols is None:
+        x_cols, _, _ = _im2col_strides_nhwc(x, HH, WW, conv_param)
+    dw = x_cols.T.dot(dout_reshaped).reshape(HH, WW, C, F).transpose(3, 2, 0, 1)
+
+    # Rather than materializing all of dx_cols and scattering it with a
+    # channels-last col2im, compute the columns for one filter offset at a time;
+    # each product is then contiguous and is added straight into dx.
+    dtype = np.result_type(w, dout)
+    dx_padded = workspace.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype)
+    for hh in range(HH):
+        for ww in range(WW):
+            y0, x0 = d * hh, d * ww
+            dx_slice = dx_padded[:, y0:y0 + stride * out_h:stride,
+                                 x0:x0 + stride * out_w:stride, :]
+            dx_slice += dout_reshaped.dot(w[:, :, hh, ww]).reshape(
+                N, out_h, out_w, C)
+    if pad > 0:
+        dx = dx_padded[:, pad:-pad, pad:-pad, :]
+    else:
+        dx = dx_padded
 
     return dx, dw, db
 
@@ -115,42 +409,735 @@ def conv_backward_im2col(dout, cache):
     db = np.sum(dout, axis=(0, 2, 3))
 
     num_filters, _, filter_height, filter_width = w.shape
+    if x_cols is None:
+        x_cols = im2col_fast(x, filter_height, filter_width, pad, stride,
+                             conv_param.get('dilation', 1))
     dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
     dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
     dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
     # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
-    dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                       filter_height, filter_width, pad, stride)
+    dx = col2im_fast(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
+                     filter_height, filter_width, pad, stride,
+                     conv_param.get('dilation', 1))
 
     return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+# Transforms for Winograd's minimal filtering algorithm F(2x2, 3x3); see Lavin
+# and Gray, "Fast Algorithms for Convolutional Neural Networks". A 4x4 input
+# tile d and a 3x3 filter g give the 2x2 output tile
+# A^T [(G g G^T) * (B^T d B)] A, where * is elementwise.
+WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                        [0, 1, 1, 0],
+                        [0, -1, 1, 0],
+                        [0, 1, 0, -1]], dtype=np.float64)
+WINOGRAD_G = np.array([[1, 0, 0],
+                       [0.5, 0.5, 0.5],
+                       [0.5, -0.5, 0.5],
+                       [0, 0, 1]], dtype=np.float64)
+WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                        [0, 1, -1, -1]], dtype=np.float64)
+
+# conv_forward_fast only uses the Winograd method for layers with at least this
+# many input channels; below that the transforms cost more than they save.
+WINOGRAD_MIN_CHANNELS = 16
+
+
+def _winograd_rows(mat, tiles, out):
+    """
+    Set out[a] = sum_i mat[a, i] * tiles[i]. The transform matrices are tiny
+    and mostly 0 and +-1, so this is cheaper as a few elementwise adds over
+    whole arrays than as a tensordot.
+    """
+    for a in range(mat.shape[0]):
+        started = False
+        for i in range(mat.shape[1]):
+            c = mat[a, i]
+            if c == 0:
+                continue
+            if not started:
+                np.multiply(tiles[i], c, out=out[a])
+                started = True
+            elif c == 1:
+                out[a] += tiles[i]
+            elif c == -1:
+                out[a] -= tiles[i]
+            else:
+                out[a] += c * tiles[i]
+        if not started:
+            out[a] = 0
+
+
+def _winograd_transform(mat, tiles):
+    """
+    Compute mat . t . mat^T for every tile t, where the tile axes are the first
+    two axes of tiles. The result has the same trailing axes as tiles.
+    """
+    m, n = mat.shape
+    tmp = np.empty((m, n) + tiles.shape[2:], dtype=tiles.dtype)
+    _winograd_rows(mat, tiles, tmp)
+    out = np.empty((m, m) + tiles.shape[2:], dtype=tiles.dtype)
+    _winograd_rows(mat, tmp.swapaxes(0, 1), out.swapaxes(0, 1))
+    return out
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer with
+    3x3 filters and stride 1, based on Winograd's F(2x2, 3x3) algorithm.
+
+    The output is computed in 2x2 tiles from overlapping 4x4 input tiles. After
+    transforming the tiles and the filters, the convolution becomes 16
+    independent matrix multiplies that need 4 multiplies per output pixel
+    rather than the 9 of im2col, and the transformed input that we keep for
+    the backward pass is about 4 times the size of x rather than the 9 times
+    of x_cols.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert (HH, WW) == (3, 3), 'Winograd convolution needs 3x3 filters'
+    assert stride == 1, 'Winograd convolution needs stride 1'
+    assert conv_param.get('dilation', 1) == 1, \
+        'Winograd convolution does not support dilation'
+
+    out_h = H + 2 * pad - 2
+    out_w = W + 2 * pad - 2
+    tiles_h = (out_h + 1) // 2
+    tiles_w = (out_w + 1) // 2
+
+    # Pad the input; an extra row / column at the bottom / right makes the
+    # output size even so that it splits into 2x2 tiles.
+    p = pad
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p + 2 * tiles_h - out_h),
+                          (p, p + 2 * tiles_w - out_w)), mode='constant')
+    _, _, Hp, Wp = x_padded.shape
+
+    # Overlapping 4x4 input tiles with stride 2, tile axes first
+    shape = (4, 4, C, N, tiles_h, tiles_w)
+    strides = (Wp, 1, Hp * Wp, C * Hp * Wp, 2 * Wp, 2)
+    strides = x.itemsize * np.array(strides)
+    d = np.lib.stride_tricks.as_strided(x_padded, shape=shape, strides=strides)
+
+    # Transform the input tiles and the filters
+    V = _winograd_transform(WINOGRAD_BT, d).reshape(16, C, -1)
+    U = _winograd_transform(WINOGRAD_G, w.transpose(2, 3, 0, 1))
+    U = U.reshape(16, F, C)
+
+    # One matrix multiply for each of the 16 tile positions
+    M = np.matmul(U, V)
+
+    # Transform back to 2x2 output tiles and stitch them together
+    M.shape = (4, 4, F, N, tiles_h, tiles_w)
+    Y = _winograd_transform(WINOGRAD_AT, M)
+    out = Y.transpose(3, 2, 4, 0, 5, 1).reshape(N, F, 2 * tiles_h, 2 * tiles_w)
+    out = out[:, :, :out_h, :out_w] + b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param, U, V)
+    return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_winograd; every step of the forward pass is
+    linear, so we just apply the transposed transforms in reverse order.
+    """
+    x, w, b, conv_param, U, V = cache
+    pad = conv_param['pad']
+
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    _, _, out_h, out_w = dout.shape
+    tiles_h = (out_h + 1) // 2
+    tiles_w = (out_w + 1) // 2
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    # Split the upstream gradient into 2x2 tiles, tile axes first
+    dY = np.zeros((N, F, 2 * tiles_h, 2 * tiles_w), dtype=dout.dtype)
+    dY[:, :, :out_h, :out_w] = dout
+    dY = dY.reshape(N, F, tiles_h, 2, tiles_w, 2).transpose(3, 5, 1, 0, 2, 4)
+
+    dM = _winograd_transform(WINOGRAD_AT.T, dY).reshape(16, F, -1)
+
+    dU = np.matmul(dM, V.transpose(0, 2, 1))
+    dU.shape = (4, 4, F, C)
+    dw = _winograd_transform(WINOGRAD_G.T, dU).transpose(2, 3, 0, 1)
+
+    dV = np.matmul(U.transpose(0, 2, 1), dM)
+    dV.shape = (4, 4, C, N, tiles_h, tiles_w)
+    dd = _winograd_transform(WINOGRAD_BT.T, dV)
+
+    # Add the overlapping input tiles back into the padded image
+    dx_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2),
+                         dtype=dout.dtype)
+    for i in range(4):
+        for j in range(4):
+            dx_slice = dx_padded[:, :, i:i + 2 * tiles_h:2, j:j + 2 * tiles_w:2]
+            dx_slice += dd[i, j].transpose(1, 0, 2, 3)
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+    return dx, dw, db
+
+
+def _fft_size(n):
+    """
+    Return the smallest integer >= n whose only prime factors are 2, 3 and 5;
+    FFTs of these lengths are much faster than those of nearby primes.
+    """
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def conv_forward_fft(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer based
+    on the FFT.
+
+    Each output channel is the sum over input channels of the cross-correlation
+    of the padded input with a filter, which is an elementwise product in the
+    frequency domain. The cost does not depend on the filter size, so this wins
+    over im2col for large filters. Strided convolutions are computed at stride
+    1 and then subsampled, so this is only a good choice for stride 1.
+
+    The spectra of the input and of the filters are kept in the cache for the
+    backward pass. Dilated convolutions are not supported.
+    """
+    assert conv_param.get('dilation', 1) == 1, \
+        'FFT convolution does not support dilation'
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    p = pad
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    fft_shape = (_fft_size(Hp), _fft_size(Wp))
+
+    x_hat = np.fft.rfft2(x_padded, fft_shape)
+    w_hat = np.fft.rfft2(w, fft_shape)
+
+    # Cross-correlation is multiplication by the conjugate spectrum; summing
+    # over channels is a matrix multiply at each frequency.
+    out_hat = np.matmul(x_hat.transpose(2, 3, 0, 1),
+                        w_hat.conj().transpose(2, 3, 1, 0))
+    out_full = np.fft.irfft2(out_hat.transpose(2, 3, 0, 1), fft_shape)
+
+    out = out_full[:, :, :Hp - HH + 1:stride, :Wp - WW + 1:stride]
+    out = (out + b.reshape(1, -1, 1, 1)).astype(x.dtype)
+
+    cache = (x, w, b, conv_param, x_hat, w_hat)
+    return out, cache
+
+
+def conv_backward_fft(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_fft.
+    """
+    x, w, b, conv_param, x_hat, w_hat = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    fft_shape = (_fft_size(Hp), _fft_size(Wp))
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    # Scatter a strided upstream gradient back onto the stride-1 output grid
+    if stride == 1:
+        dout_full = dout
+    else:
+        dout_full = np.zeros((N, F, Hp - HH + 1, Wp - WW + 1), dtype=dout.dtype)
+        dout_full[:, :, ::stride, ::stride] = dout
+    dout_hat = np.fft.rfft2(dout_full, fft_shape).transpose(2, 3, 0, 1)
+
+    # dx is the full convolution of dout with the filters
+    dx_hat = np.matmul(dout_hat, w_hat.transpose(2, 3, 0, 1))
+    dx_padded = np.fft.irfft2(dx_hat.transpose(2, 3, 0, 1), fft_shape)
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W].astype(x.dtype)
+
+    # dw is the cross-correlation of the padded input with dout
+    dw_hat = np.matmul(dout_hat.conj().transpose(0, 1, 3, 2),
+                       x_hat.transpose(2, 3, 0, 1))
+    dw = np.fft.irfft2(dw_hat.transpose(2, 3, 0, 1), fft_shape)
+    dw = dw[:, :, :HH, :WW].astype(w.dtype)
+
+    return dx, dw, db
+
+
+# conv_forward_fast uses the FFT method for stride-1 convolutions with filters
+# of at least fft_min_filter_size and at least fft_min_channels input channels.
+# Where the FFT method starts to win depends on the machine and on the layer,
+# so it is off (fft_min_filter_size is None) until calibrate_fft_crossover()
+# in benchmarks.py has measured both thresholds, or they are set by hand.
+fft_min_filter_size = None
+fft_min_channels = 1
+
+
+def measure_fft_crossover(N=10, C=16, H=32, W=32, num_filters=16,
+                          filter_sizes=(3, 5, 7, 9, 11), dtype=np.float32,
+                          num_trials=2, seed=0, verbose=False):
+    """
+    Time a forward and backward pass of a stride-1 convolution with the
+    stride-trick and FFT methods for each of filter_sizes, and return the
+    smallest filter size from which the FFT method is faster for that size and
+    every larger one. Returns None if the FFT method never wins.
+
+    The test data is drawn from a RandomState with the given seed, so the
+    global random state is left alone.
+    """
+    from time import time
+
+    rng = np.random.RandomState(seed)
+    x = rng.randn(N, C, H, W).astype(dtype)
+    fft_wins = []
+    for filter_size in filter_sizes:
+        w = rng.randn(num_filters, C, filter_size, filter_size).astype(dtype)
+        b = np.zeros(num_filters, dtype=dtype)
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+        times = []
+        for forward, backward in [(conv_forward_strides, conv_backward_strides),
+                                  (conv_forward_fft, conv_backward_fft)]:
+            best = None
+            for _ in range(num_trials):
+                t0 = time()
+                out, cache = forward(x, w, b, conv_param)
+                backward(out, cache)
+                t1 = time()
+                if best is None or t1 - t0 < best:
+                    best = t1 - t0
+            times.append(best)
+        if verbose:
+            print('filter size %d: strides %fs, fft %fs' % (filter_size,
+                                                            times[0], times[1]))
+        fft_wins.append(times[1] < times[0])
+
+    crossover = None
+    for filter_size, wins in reversed(list(zip(filter_sizes, fft_wins))):
+        if not wins:
+            break
+        crossover = filter_size
+    return crossover
+
+
+def conv_forward_grouped(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a grouped convolution (see
+    conv_forward_grouped_naive), based on stride tricks.
+
+    We build the columns for all groups with one strided copy, and then a
+    single batched matrix multiply computes every group at once. Like the
+    im2col and stride-trick methods, this honors conv_param['recompute'].
+    """
+    N, C, H, W = x.shape
+    F, Cg, HH, WW = w.shape
+    G = conv_param.get('groups', 1)
+    assert C == G * Cg and F % G == 0, 'Invalid groups'
+    Fg = F // G
+
+    # The channels of each group are contiguous, so the columns for group g
+    # are a contiguous block of the rows of the ordinary im2col columns
+    x_cols, out_h, out_w = _im2col_strides(x, HH, WW, conv_param)
+    x_cols.shape = (G, Cg * HH * WW, N * out_h * out_w)
+
+    # One matrix multiply per group
+    res = np.matmul(w.reshape(G, Fg, -1), x_cols)
+    res.shape = (F, N, out_h, out_w)
+    out = res.transpose(1, 0, 2, 3) + b.reshape(1, -1, 1, 1)
+    out = np.ascontiguousarray(out)
+
+    # In recompute mode the backward pass rebuilds the columns from x
+    if conv_param.get('recompute', False):
+        workspace.release(x_cols)
+        x_cols = None
+
+    cache = (x, w, b, conv_param, x_cols)
+    return out, cache
+
+
+def conv_backward_grouped(dout, cache):
+    """
+    A fast implementation of the backward pass for a grouped convolution
+    computed with conv_forward_grouped.
+    """
+    x, w, b, conv_param, x_cols = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    N, C, H, W = x.shape
+    F, Cg, HH, WW = w.shape
+    G = C // Cg
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    if x_cols is None:
+        x_cols, _, _ = _im2col_strides(x, HH, WW, conv_param)
+        x_cols.shape = (G, Cg * HH * WW, N * out_h * out_w)
+    dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(G, F // G, -1)
+    dw = np.matmul(dout_reshaped, x_cols.transpose(0, 2, 1)).reshape(w.shape)
+
+    dx_cols = np.matmul(w.reshape(G, F // G, -1).transpose(0, 2, 1),
+                        dout_reshaped)
+    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
+    dx = col2im_6d_fast(dx_cols, N, C, H, W, HH, WW, pad, stride,
+                        conv_param.get('dilation', 1))
+
+    return dx, dw, db
+
+
+def conv_forward_depthwise(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a depthwise convolution: a
+    grouped convolution with one input channel per group, where each channel
+    is convolved with its own F / C filters.
+
+    With a single input channel per group the matrix multiplies would be tiny,
+    so instead we loop over the HH * WW filter offsets and accumulate a
+    broadcast multiply of a strided slice of the input. This never builds
+    columns, and the cache holds only the input.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+    assert w.shape[1] == 1 and F % C == 0, 'Invalid depthwise filters'
+    M = F // C
+
+    p = pad
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    out_h = (H + 2 * pad - d * (HH - 1) - 1) // stride + 1
+    out_w = (W + 2 * pad - d * (WW - 1) - 1) // stride + 1
+
+    # Filter m of channel c is filter c * M + m
+    w_reshaped = w.reshape(C, M, HH, WW)
+    out = np.zeros((N, C, M, out_h, out_w), dtype=x.dtype)
+    for i in range(HH):
+        for j in range(WW):
+            x_slice = x_padded[:, :, d * i:d * i + stride * out_h:stride,
+                               d * j:d * j + stride * out_w:stride]
+            out += x_slice[:, :, np.newaxis] * w_reshaped[:, :, i, j, np.newaxis, np.newaxis]
+    out = out.reshape(N, F, out_h, out_w) + b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_depthwise(dout, cache):
+    """
+    A fast implementation of the backward pass for a depthwise convolution
+    computed with conv_forward_depthwise.
+    """
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    d = conv_param.get('dilation', 1)
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    M = F // C
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    p = pad
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    dx_padded = np.zeros_like(x_padded)
+    dout_reshaped = dout.reshape(N, C, M, out_h, out_w)
+    w_reshaped = w.reshape(C, M, HH, WW)
+    dw = np.zeros((C, M, HH, WW), dtype=w.dtype)
+    for i in range(HH):
+        for j in range(WW):
+            x_slice = x_padded[:, :, d * i:d * i + stride * out_h:stride,
+                               d * j:d * j + stride * out_w:stride]
+            dw[:, :, i, j] = np.einsum('ncmhw,nchw->cm', dout_reshaped, x_slice)
+            dx_slice = dx_padded[:, :, d * i:d * i + stride * out_h:stride,
+                                 d * j:d * j + stride * out_w:stride]
+            dx_slice += np.einsum('ncmhw,cm->nchw', dout_reshaped,
+                                  w_reshaped[:, :, i, j])
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+    return dx, dw.reshape(w.shape), db
+
+
+def _nhwc_method(forward, backward):
+    """
+    Forward and backward functions that run an NCHW-only convolution method on
+    NHWC data, through transposed views of the input, output and gradients.
+    """
+    def forward_nhwc(x, w, b, conv_param):
+        out, cache = forward(x.transpose(0, 3, 1, 2), w, b,
+                             dict(conv_param, layout='NCHW'))
+        return out.transpose(0, 2, 3, 1), cache
+
+    def backward_nhwc(dout, cache):
+        dx, dw, db = backward(dout.transpose(0, 3, 1, 2), cache)
+        return dx.transpose(0, 2, 3, 1), dw, db
+
+    return forward_nhwc, backward_nhwc
+
+
+# Forward and backward functions for each convolution method, by name. The
+# grouped methods only work on NCHW data; their _nhwc variants take NHWC data.
+CONV_METHODS = {
+    'naive': (conv_forward_naive, conv_backward_naive),
+    'naive2': (conv_forward_naive2, conv_backward_naive),
+    'im2col': (conv_forward_im2col, conv_backward_im2col),
+    'strides': (conv_forward_strides, conv_backward_strides),
+    'tiled': (conv_forward_tiled, conv_backward_tiled),
+    'winograd': (conv_forward_winograd, conv_backward_winograd),
+    'fft': (conv_forward_fft, conv_backward_fft),
+    'grouped_naive': (conv_forward_grouped_naive, conv_backward_grouped_naive),
+    'grouped': (conv_forward_grouped, conv_backward_grouped),
+    'depthwise': (conv_forward_depthwise, conv_backward_depthwise),
+}
+for _method in ('grouped_naive', 'grouped', 'depthwise'):
+    CONV_METHODS[_method + '_nhwc'] = _nhwc_method(*CONV_METHODS[_method])
+
+
+def conv_methods_for(x, w, conv_param):
+    """
+    Return the names of the convolution methods in CONV_METHODS that support a
+    convolution of x with w using conv_param.
+    """
+    nchw = conv_param.get('layout', 'NCHW') == 'NCHW'
+    if conv_param.get('groups', 1) > 1:
+        methods = ['grouped_naive', 'grouped']
+        if w.shape[1] == 1:
+            methods.append('depthwise')
+        if not nchw:
+            methods = [method + '_nhwc' for method in methods]
+        return methods
+    if not nchw:
+        return ['strides']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    dilation = conv_param.get('dilation', 1)
+    span_h, span_w = dilation * (HH - 1) + 1, dilation * (WW - 1) + 1
+    methods = ['naive', 'naive2', 'strides', 'tiled']
+    if (H + 2 * pad - span_h) % stride == 0 and (W + 2 * pad - span_w) % stride == 0:
+        methods.append('im2col')
+    # The Winograd and FFT caches hold transformed copies of the input that
+    # are larger than x, so they are no use in recompute mode
+    if dilation > 1 or conv_param.get('recompute', False):
+        return methods
+    methods.append('fft')
+    if (HH, WW) == (3, 3) and stride == 1:
+        methods.append('winograd')
+    return methods
+
+
+# Autotuning state: whether conv_forward_fast autotunes, the best method found
+# for each key returned by conv_plan_key, and the JSON file (if any) that the
+# plans are loaded from and saved to.
+conv_autotune = False
+conv_plans = {}
+conv_plan_file = None
+
+
+def enable_conv_autotune(plan_file=None):
+    """
+    Make conv_forward_fast pick the method for each convolution by timing all
+    of the methods that support it the first time it sees its shape, rather
+    than by the fixed rules.
+
+    Inputs:
+    - plan_file: If not None, the path of a JSON file in which to remember the
+      winners. Plans already in the file are loaded now, and new plans are
+      written back as they are found, so later processes skip the tuning.
+      Plans naming a method that is not in CONV_METHODS (from an older
+      version, or edited by hand) are dropped, so those shapes are tuned
+      again.
+    """
+    global conv_autotune, conv_plan_file
+    conv_autotune = True
+    conv_plan_file = plan_file
+    if plan_file is not None and os.path.exists(plan_file):
+        with open(plan_file, 'r') as f:
+            plans = json.load(f)
+        conv_plans.update((key, method) for key, method in plans.items()
+                          if method in CONV_METHODS)
+
+
+def disable_conv_autotune():
+    """ Go back to the fixed rules in conv_forward_fast. """
+    global conv_autotune, conv_plan_file
+    conv_autotune = False
+    conv_plan_file = None
+
+
+def conv_plan_key(x, w, conv_param):
+    """ The key under which the plan for a convolution is remembered. """
+    key = 'x=%s w=%s stride=%d pad=%d dtype=%s' % (
+        tuple(x.shape), tuple(w.shape), conv_param['stride'],
+        conv_param['pad'], x.dtype.name)
+    if conv_param.get('groups', 1) > 1:
+        key += ' groups=%d' % conv_param['groups']
+    if conv_param.get('dilation', 1) > 1:
+        key += ' dilation=%d' % conv_param['dilation']
+    if conv_param.get('recompute', False):
+        key += ' recompute'
+    return key
+
+
+def autotune_conv(x, w, b, conv_param, num_trials=1):
+    """
+    Return the name of the fastest method for a convolution of x with w,
+    timing a forward and backward pass of every supported method if this shape
+    has not been seen before.
+
+    A method whose forward pass alone is slower than the best complete pass so
+    far is not timed any further, which keeps the cost of trying the naive
+    methods on large layers down.
+    """
+    from time import time
+
+    key = conv_plan_key(x, w, conv_param)
+    methods = conv_methods_for(x, w, conv_param)
+    if conv_plans.get(key) in methods:
+        return conv_plans[key]
+
+    best_method, best_time = None, None
+    for method in methods:
+        forward, backward = CONV_METHODS[method]
+        for _ in range(num_trials):
+            t0 = time()
+            out, cache = forward(x, w, b, conv_param)
+            t1 = time()
+            if best_time is not None and t1 - t0 >= best_time:
+                break
+            backward(out, cache)
+            t2 = time()
+            if best_time is None or t2 - t0 < best_time:
+                best_method, best_time = method, t2 - t0
+
+    conv_plans[key] = best_method
+    if conv_plan_file is not None:
+        tmp_file = conv_plan_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(conv_plans, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, conv_plan_file)
+    return best_method
+
+
+def conv_forward_fast(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer.
+
+    If autotuning has been turned on with enable_conv_autotune, this uses the
+    method that autotune_conv found to be fastest for this shape. Grouped
+    convolutions (conv_param['groups'] > 1) use the depthwise method when
+    there is one input channel per group and the batched grouped method
+    otherwise. Dilated convolutions, and convolutions in recompute mode
+    (conv_param['recompute'] is True, so that the cache keeps only x and the
+    backward pass rebuilds the im2col columns), use the stride-trick im2col
+    method. Grouped convolutions on NHWC data run these methods on transposed
+    views. For ordinary convolutions it chooses between the available methods
+    based on the layer shape: 3x3 convolutions with stride 1 use the Winograd
+    method, stride-1 convolutions with filters of at least fft_min_filter_size
+    and at least fft_min_channels input channels use the FFT method (once
+    calibrate_fft_crossover has set these), and everything else uses the
+    stride-trick im2col method. The Winograd transforms are elementwise passes over the data that
+    only pay for themselves when the matrix multiply is big enough, so layers
+    with fewer than WINOGRAD_MIN_CHANNELS input channels (such as the first
+    layer of a network on RGB images) also use the im2col method.
+
+    When the stride-trick method would need more than the scratch budget
+    (conv_param['scratch_bytes'], or conv_scratch_bytes) for the columns of
+    the whole minibatch, the tiled method is used instead.
+    """
+    nchw = conv_param.get('layout', 'NCHW') == 'NCHW'
+    stride_one = conv_param['stride'] == 1
+    if conv_autotune and nchw:
+        method = autotune_conv(x, w, b, conv_param)
+    elif conv_param.get('groups', 1) > 1:
+        method = 'depthwise' if w.shape[1] == 1 else 'grouped'
+        if not nchw:
+            method += '_nhwc'
+    elif conv_param.get('dilation', 1) > 1 or conv_param.get('recompute', False):
+        method = 'strides'
+    elif (w.shape[2:] == (3, 3) and stride_one and nchw
+          and w.shape[1] >= WINOGRAD_MIN_CHANNELS):
+        method = 'winograd'
+    elif (nchw and stride_one and fft_min_filter_size is not None
+          and min(w.shape[2:]) >= fft_min_filter_size
+          and w.shape[1] >= fft_min_channels):
+        method = 'fft'
+    else:
+        method = 'strides'
+
+    if (method == 'strides' and nchw
+            and _conv_tile_size(x, w, conv_param) < x.shape[0]):
+        method = 'tiled'
+
+    forward, _ = CONV_METHODS[method]
+    out, real_cache = forward(x, w, b, conv_param)
+    cache = (method, real_cache)
+    return out, cache
+
+
+def conv_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer.
+
+    This switches between methods depending on which one was used to generate
+    the cache.
+    """
+    method, real_cache = cache
+    if method not in CONV_METHODS:
+        raise ValueError('Unrecognized method "%s"' % method)
+    _, backward = CONV_METHODS[method]
+    return backward(dout, real_cache)
 
 
 def max_pool_forward_fast(x, pool_param):
     """
     A fast implementation of the forward pass for a max pooling layer.
 
-    This chooses between the reshape method and the im2col method. If the pooling
-    regions are square and tile the input image, then we can use the reshape
-    method which is very fast. Otherwise we fall back on the im2col method, which
-    is not much faster than the naive method.
+    This chooses between the reshape method and the argmax method. If the
+    pooling regions are square and tile the input image, then we can use the
+    reshape method which is very fast. Otherwise (overlapping windows such as
+    3x3 pools with stride 2, windows that do not tile the input, or padding)
+    we use the argmax method, which takes a running maximum over strided views
+    of the input and is about as fast.
+
+    If pool_param['layout'] is 'NHWC' then x has shape (N, H, W, C) and so does
+    the output. pool_param may also have a 'pad' key, as described in
+    max_pool_forward_argmax.
+
+    If pool_param['argmax'] is true, the argmax method is used for pools that
+    tile the input too. Its cache holds an int8 window offset per output
+    instead of the input and the output, and its backward pass scatters the
+    gradients directly instead of rebuilding a full-size equality mask, which
+    makes it several times faster than the reshape backward pass. Ties get
+    all of the gradient at the first maximum rather than at every maximum.
     """
-    N, C, H, W = x.shape
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
     stride = pool_param['stride']
 
     same_size = pool_height == pool_width == stride
     tiles = H % pool_height == 0 and W % pool_width == 0
-    if same_size and tiles:
+    use_argmax = pool_param.get('argmax', False) or pool_param.get('pad', 0)
+    if same_size and tiles and not use_argmax:
         out, reshape_cache = max_pool_forward_reshape(x, pool_param)
         cache = ('reshape', reshape_cache)
     else:
-        out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-        cache = ('im2col', im2col_cache)
+        out, argmax_cache = max_pool_forward_argmax(x, pool_param)
+        cache = ('argmax', argmax_cache)
     return out, cache
 
 
@@ -158,12 +1145,14 @@ def max_pool_backward_fast(dout, cache):
     """
     A fast implementation of the backward pass for a max pooling layer.
 
-    This switches between the reshape method an the im2col method depending on
+    This switches between the reshape, argmax and im2col methods depending on
     which method was used to generate the cache.
     """
     method, real_cache = cache
     if method == 'reshape':
         return max_pool_backward_reshape(dout, real_cache)
+    elif method == 'argmax':
+        return max_pool_backward_argmax(dout, real_cache)
     elif method == 'im2col':
         return max_pool_backward_im2col(dout, real_cache)
     else:
@@ -177,17 +1166,26 @@ def max_pool_forward_reshape(x, pool_param):
 
     This can only be used for square pooling regions that tile the input.
     """
-    N, C, H, W = x.shape
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
     stride = pool_param['stride']
     assert pool_height == pool_width == stride, 'Invalid pool params'
     assert H % pool_height == 0
     assert W % pool_height == 0
-    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
-                           W // pool_width, pool_width)
-    out = x_reshaped.max(axis=3).max(axis=4)
+    if nhwc:
+        x_reshaped = x.reshape(N, H // pool_height, pool_height,
+                               W // pool_width, pool_width, C)
+        out = x_reshaped.max(axis=2).max(axis=3)
+    else:
+        x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                               W // pool_width, pool_width)
+        out = x_reshaped.max(axis=3).max(axis=4)
 
-    cache = (x, x_reshaped, out)
+    cache = (x, x_reshaped, out, pool_param)
     return out, cache
 
 
@@ -208,15 +1206,24 @@ def max_pool_backward_reshape(dout, cache):
     however this results in a significant performance penalty (about 40% slower)
     and is unlikely to matter in practice so we don't do it.
     """
-    x, x_reshaped, out = cache
+    x, x_reshaped, out, pool_param = cache
 
-    dx_reshaped = np.zeros_like(x_reshaped)
-    out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
-    mask = (x_reshaped == out_newaxis)
-    dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
+    if pool_param.get('layout', 'NCHW') == 'NHWC':
+        pool_axes = (2, 4)
+        out_newaxis = out[:, :, np.newaxis, :, np.newaxis, :]
+        dout_newaxis = dout[:, :, np.newaxis, :, np.newaxis, :]
+    else:
+        pool_axes = (3, 5)
+        out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
+        dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
+
+    dx_reshaped = workspace.zeros(x_reshaped.shape, x_reshaped.dtype)
+    mask = np.equal(x_reshaped, out_newaxis,
+                    out=workspace.empty(x_reshaped.shape, np.bool_))
     dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
     dx_reshaped[mask] = dout_broadcast[mask]
-    dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
+    dx_reshaped /= np.sum(mask, axis=pool_axes, keepdims=True)
+    workspace.release(mask)
     dx = dx_reshaped.reshape(x.shape)
 
     return dx
@@ -269,3 +1276,287 @@ def max_pool_backward_im2col(dout, cache):
     dx = dx.reshape(x.shape)
 
     return dx
+
+
+def _pool_tap(offset, stride, size, out_size):
+    """
+    The outputs along one axis whose pooling windows contain the input
+    position offset + stride * o (offset is negative for taps that may fall in
+    the padding), and the input positions they read, both as slices. Windows
+    for which that position lies outside the input are left out.
+    """
+    lo = min(out_size, max(0, (stride - 1 - offset) // stride))
+    hi = max(lo, min(out_size, (size - 1 - offset) // stride + 1))
+    start = offset + stride * lo
+    return slice(lo, hi), slice(start, start + stride * (hi - lo), stride)
+
+
+def _pool_window(pool_param, i, j, x_shape, out_height, out_width):
+    """
+    Indices that pick element (i, j) of every pooling window out of the input,
+    as a strided view, together with the indices of the outputs those windows
+    belong to. With padding the windows at the border are clipped to the
+    input, so the padding is never materialized.
+    """
+    stride, pad = pool_param['stride'], pool_param.get('pad', 0)
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    H, W = x_shape[1:3] if nhwc else x_shape[2:]
+    out_rows, rows = _pool_tap(i - pad, stride, H, out_height)
+    out_cols, cols = _pool_tap(j - pad, stride, W, out_width)
+    if nhwc:
+        return (slice(None), out_rows, out_cols), (slice(None), rows, cols)
+    return ((slice(None), slice(None), out_rows, out_cols),
+            (slice(None), slice(None), rows, cols))
+
+
+def max_pool_forward_argmax(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max pooling layer that
+    remembers where each maximum came from instead of keeping the input.
+
+    We loop over the pool_height * pool_width positions in the pooling window,
+    taking a running maximum over strided views of the input. Alongside it we
+    record the position of the maximum within its window as an int8 (or int16
+    for windows of more than 128 elements), so the cache is a small fraction of
+    the size of x. This works for any pool size and stride, including
+    overlapping windows. Ties go to the first maximum in the window.
+
+    If pool_param has a 'pad' key, the input is implicitly padded with -inf on
+    each side by that many pixels; pad must be smaller than the pool size so
+    that every window contains at least one input pixel.
+    """
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride, pad = pool_param['stride'], pool_param.get('pad', 0)
+    assert pad < pool_height and pad < pool_width, 'Invalid pad'
+
+    out_height = (H + 2 * pad - pool_height) // stride + 1
+    out_width = (W + 2 * pad - pool_width) // stride + 1
+    offset_dtype = np.int8 if pool_height * pool_width <= 128 else np.int16
+
+    if pad > 0:
+        if nhwc:
+            out_shape = (N, out_height, out_width, C)
+        else:
+            out_shape = (N, C, out_height, out_width)
+        out = np.full(out_shape, -np.inf, dtype=x.dtype)
+        first = 0
+    else:
+        _, x_idx = _pool_window(pool_param, 0, 0, x.shape, out_height, out_width)
+        out = x[x_idx].copy()
+        first = 1
+    argmax = np.zeros(out.shape, dtype=offset_dtype)
+    for k in range(first, pool_height * pool_width):
+        i, j = divmod(k, pool_width)
+        out_idx, x_idx = _pool_window(pool_param, i, j, x.shape,
+                                      out_height, out_width)
+        x_window, out_window = x[x_idx], out[out_idx]
+        argmax[out_idx][x_window > out_window] = k
+        np.maximum(out_window, x_window, out=out_window)
+
+    cache = (x.shape, argmax, pool_param)
+    return out, cache
+
+
+def max_pool_backward_argmax(dout, cache):
+    """
+    A fast implementation of the backward pass for a max pooling layer
+    computed with max_pool_forward_argmax.
+
+    The window offsets in the cache are turned into flat indices of the input
+    positions the maxima came from, and the upstream gradients are scattered
+    to them with a single np.bincount, which also sums the contributions of
+    overlapping windows.
+    """
+    x_shape, argmax, pool_param = cache
+    pool_width = pool_param['pool_width']
+    stride, pad = pool_param['stride'], pool_param.get('pad', 0)
+    i, j = argmax // pool_width, argmax % pool_width
+
+    if pool_param.get('layout', 'NCHW') == 'NHWC':
+        N, H, W, C = x_shape
+        out_height, out_width = argmax.shape[1:3]
+        rows = i + (stride * np.arange(out_height) - pad)[:, None, None]
+        cols = j + (stride * np.arange(out_width) - pad)[:, None]
+        index = (rows * W + cols) * C + np.arange(C)
+        index += H * W * C * np.arange(N).reshape(N, 1, 1, 1)
+    else:
+        N, C, H, W = x_shape
+        out_height, out_width = argmax.shape[2:]
+        rows = i + (stride * np.arange(out_height) - pad)[:, None]
+        cols = j + (stride * np.arange(out_width) - pad)
+        index = rows * W + cols
+        index += H * W * np.arange(N * C).reshape(N, C, 1, 1)
+
+    dx = np.bincount(index.ravel(), weights=dout.ravel(),
+                     minlength=N * C * H * W)
+    dx = dx.astype(dout.dtype, copy=False).reshape(x_shape)
+    return dx
+
+
+def avg_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer.
+
+    As in max_pool_forward_fast, pools that are square and tile the input use
+    the reshape method; everything else (overlapping windows, windows that do
+    not tile the input, or padding) uses the strides method, which sums
+    strided views of the input over the positions in the pooling window.
+
+    pool_param takes the same keys as for avg_pool_forward_naive, plus
+    'layout'. Neither method needs to keep x for the backward pass.
+    """
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+
+    same_size = pool_height == pool_width == stride
+    tiles = H % pool_height == 0 and W % pool_width == 0
+    if same_size and tiles and not pool_param.get('pad', 0):
+        out, reshape_cache = avg_pool_forward_reshape(x, pool_param)
+        cache = ('reshape', reshape_cache)
+    else:
+        out, strides_cache = avg_pool_forward_strides(x, pool_param)
+        cache = ('strides', strides_cache)
+    return out, cache
+
+
+def avg_pool_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer.
+
+    This switches between the reshape and strides methods depending on which
+    method was used to generate the cache.
+    """
+    method, real_cache = cache
+    if method == 'reshape':
+        return avg_pool_backward_reshape(dout, real_cache)
+    elif method == 'strides':
+        return avg_pool_backward_strides(dout, real_cache)
+    else:
+        raise ValueError('Unrecognized method "%s"' % method)
+
+
+def avg_pool_forward_reshape(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer
+    that reshapes the input so that each pooling window gets its own pair of
+    axes and averages over them.
+
+    This can only be used for square pooling regions that tile the input.
+    """
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    assert pool_height == pool_width == stride, 'Invalid pool params'
+    assert H % pool_height == 0
+    assert W % pool_height == 0
+    if nhwc:
+        x_reshaped = x.reshape(N, H // pool_height, pool_height,
+                               W // pool_width, pool_width, C)
+        out = x_reshaped.mean(axis=(2, 4))
+    else:
+        x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                               W // pool_width, pool_width)
+        out = x_reshaped.mean(axis=(3, 5))
+
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_reshape(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer
+    computed with avg_pool_forward_reshape; the scaled upstream gradient is
+    broadcast over each window.
+    """
+    x_shape, pool_param = cache
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+
+    if pool_param.get('layout', 'NCHW') == 'NHWC':
+        N, out_height, out_width, C = dout.shape
+        dx_reshaped = np.empty((N, out_height, pool_height, out_width,
+                                pool_width, C), dtype=dout.dtype)
+        dout_newaxis = dout[:, :, np.newaxis, :, np.newaxis, :]
+    else:
+        N, C, out_height, out_width = dout.shape
+        dx_reshaped = np.empty((N, C, out_height, pool_height, out_width,
+                                pool_width), dtype=dout.dtype)
+        dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
+    np.multiply(dout_newaxis, 1.0 / (pool_height * pool_width),
+                out=dx_reshaped)
+    dx = dx_reshaped.reshape(x_shape)
+
+    return dx
+
+
+def avg_pool_forward_strides(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer
+    that works for any pool size, stride and padding.
+
+    We add up strided views of the input, one for each of the
+    pool_height * pool_width positions in the pooling window; windows are
+    clipped to the input as in max_pool_forward_argmax, which leaves out the
+    zeros of the padding, and the padding still counts towards the average.
+    """
+    nhwc = pool_param.get('layout', 'NCHW') == 'NHWC'
+    if nhwc:
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride, pad = pool_param['stride'], pool_param.get('pad', 0)
+
+    out_height = (H + 2 * pad - pool_height) // stride + 1
+    out_width = (W + 2 * pad - pool_width) // stride + 1
+    if nhwc:
+        out = np.zeros((N, out_height, out_width, C), dtype=x.dtype)
+    else:
+        out = np.zeros((N, C, out_height, out_width), dtype=x.dtype)
+
+    for k in range(pool_height * pool_width):
+        i, j = divmod(k, pool_width)
+        out_idx, x_idx = _pool_window(pool_param, i, j, x.shape,
+                                      out_height, out_width)
+        out[out_idx] += x[x_idx]
+    out /= pool_height * pool_width
+
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_strides(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer
+    computed with avg_pool_forward_strides; the scaled upstream gradient is
+    added into a strided view of dx for each position in the pooling window.
+    """
+    x_shape, pool_param = cache
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    if pool_param.get('layout', 'NCHW') == 'NHWC':
+        out_height, out_width = dout.shape[1:3]
+    else:
+        out_height, out_width = dout.shape[2:]
+
+    dx = np.zeros(x_shape, dtype=dout.dtype)
+    dout_scaled = dout / (pool_height * pool_width)
+    for k in range(pool_height * pool_width):
+        i, j = divmod(k, pool_width)
+        out_idx, x_idx = _pool_window(pool_param, i, j, x_shape,
+                                      out_height, out_width)
+        dx[x_idx] += dout_scaled[out_idx]
+
+    return dx
@@ -1,56 +1,174 @@
 from builtins import range
+from functools import lru_cache
+
 import numpy as np
 
 
-def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
-    # First figure out what the size of the output should be
+# Maximum number of index plans kept by the im2col plan caches below; each
+# distinct input shape / field / padding / stride combination needs one.
+IM2COL_PLAN_CACHE_SIZE = 32
+
+
+def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1,
+                       dilation=1):
+    """
+    Return the (k, i, j) fancy indices into the padded input that gather the
+    im2col columns. These only depend on the shape, so they are computed once
+    per shape and reused; the returned arrays are read-only.
+
+    With dilation > 1 the taps of the field are dilation pixels apart, so the
+    field covers dilation * (field_height - 1) + 1 rows of the input.
+    """
     N, C, H, W = x_shape
-    assert (H + 2 * padding - field_height) % stride == 0
-    assert (W + 2 * padding - field_height) % stride == 0
-    out_height = (H + 2 * padding - field_height) / stride + 1
-    out_width = (W + 2 * padding - field_width) / stride + 1
+    return _im2col_indices_plan(C, H, W, field_height, field_width, padding,
+                                stride, dilation)
+
 
-    i0 = np.repeat(np.arange(field_height), field_width)
+@lru_cache(maxsize=IM2COL_PLAN_CACHE_SIZE)
+def _im2col_indices_plan(C, H, W, field_height, field_width, padding, stride,
+                         dilation=1):
+    # First figure out what the size of the output should be
+    span_height = dilation * (field_height - 1) + 1
+    span_width = dilation * (field_width - 1) + 1
+    assert (H + 2 * padding - span_height) % stride == 0
+    assert (W + 2 * padding - span_width) % stride == 0
+    out_height = (H + 2 * padding - span_height) // stride + 1
+    out_width = (W + 2 * padding - span_width) // stride + 1
+
+    i0 = dilation * np.repeat(np.arange(field_height), field_width)
     i0 = np.tile(i0, C)
     i1 = stride * np.repeat(np.arange(out_height), out_width)
-    j0 = np.tile(np.arange(field_width), field_height * C)
+    j0 = dilation * np.tile(np.arange(field_width), field_height * C)
     j1 = stride * np.tile(np.arange(out_width), out_height)
     i = i0.reshape(-1, 1) + i1.reshape(1, -1)
     j = j0.reshape(-1, 1) + j1.reshape(1, -1)
 
     k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
+    for a in (k, i, j):
+        a.flags.writeable = False
     return (k, i, j)
 
 
-def im2col_indices(x, field_height, field_width, padding=1, stride=1):
-    """ An implementation of im2col based on some fancy indexing """
-    # Zero-pad the input
+@lru_cache(maxsize=IM2COL_PLAN_CACHE_SIZE)
+def _im2col_flat_plan(C, H, W, field_height, field_width, padding, stride,
+                      dilation=1):
+    """
+    Flat indices into a padded image of shape (C, H + 2 * padding,
+    W + 2 * padding) that gather its im2col columns, raveled in column order,
+    so that a single np.take replaces indexing with the three (k, i, j) arrays.
+    """
+    k, i, j = _im2col_indices_plan(C, H, W, field_height, field_width,
+                                   padding, stride, dilation)
+    H_padded, W_padded = H + 2 * padding, W + 2 * padding
+    flat = ((k * H_padded + i) * W_padded + j).ravel()
+    flat.flags.writeable = False
+    return flat
+
+
+def clear_im2col_plans():
+    """ Drop all of the cached im2col index plans. """
+    _im2col_indices_plan.cache_clear()
+    _im2col_flat_plan.cache_clear()
+
+
+def im2col_indices(x, field_height, field_width, padding=1, stride=1,
+                   dilation=1, out=None):
+    """
+    An implementation of im2col based on some fancy indexing.
+
+    We zero-pad the input into a (C, H, W, N) buffer so that the gather copies
+    runs of N contiguous elements and produces the columns directly in their
+    final (C * field_height * field_width, out_height * out_width * N) layout.
+    If out is given the columns are written into it; it must be a contiguous
+    array of that shape.
+    """
+    N, C, H, W = x.shape
     p = padding
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    x_padded = np.zeros((C, H + 2 * p, W + 2 * p, N), dtype=x.dtype)
+    x_padded[:, p:p + H, p:p + W, :] = x.transpose(1, 2, 3, 0)
+
+    flat = _im2col_flat_plan(C, H, W, field_height, field_width, padding,
+                             stride, dilation)
 
-    k, i, j = get_im2col_indices(x.shape, field_height, field_width, padding,
-                                 stride)
+    # The indices are always in range; with mode='raise' np.take would gather
+    # into a temporary and copy it into out
+    if out is not None:
+        out = out.reshape(flat.shape[0], N)
+    cols = np.take(x_padded.reshape(-1, N), flat, axis=0, out=out, mode='clip')
+    return cols.reshape(field_height * field_width * C, -1)
 
-    cols = x_padded[:, k, i, j]
-    C = x.shape[1]
-    cols = cols.transpose(1, 2, 0).reshape(field_height * field_width * C, -1)
-    return cols
+
+# Generic entry point, used by the im2col max pooling layer
+im2col = im2col_indices
 
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
-                   stride=1):
-    """ An implementation of col2im based on fancy indexing and np.add.at """
+                   stride=1, dilation=1):
+    """
+    An implementation of col2im that loops over the field_height * field_width
+    filter offsets and adds the columns for each one into a strided slice of
+    the padded image.
+
+    This gives exactly the same result as scattering with np.add.at, since
+    each pixel receives its contributions in the same order, but is much
+    faster because every add is a single vectorized operation.
+    """
     N, C, H, W = x_shape
+    span_height = dilation * (field_height - 1) + 1
+    span_width = dilation * (field_width - 1) + 1
+    out_height = (H + 2 * padding - span_height) // stride + 1
+    out_width = (W + 2 * padding - span_width) // stride + 1
     H_padded, W_padded = H + 2 * padding, W + 2 * padding
-    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                                 stride)
-    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
-    if padding == 0:
-        return x_padded
-    return x_padded[:, :, padding:-padding, padding:-padding]
-
-pass
+
+    # Accumulate in (C, H, W, N) order to match the column layout
+    x_padded = np.zeros((C, H_padded, W_padded, N), dtype=cols.dtype)
+    cols_reshaped = cols.reshape(C, field_height, field_width,
+                                 out_height, out_width, N)
+    for i in range(field_height):
+        for j in range(field_width):
+            y0, x0 = dilation * i, dilation * j
+            x_slice = x_padded[:, y0:y0 + stride * out_height:stride,
+                               x0:x0 + stride * out_width:stride, :]
+            x_slice += cols_reshaped[:, i, j]
+    x = x_padded[:, padding:padding + H, padding:padding + W, :]
+    return x.transpose(3, 0, 1, 2)
+
+
+def col2im_numpy(cols, N, C, H, W, field_height, field_width, padding, stride,
+                 dilation=1):
+    """ col2im_indices with the same call signature as col2im_cython """
+    return col2im_indices(cols, (N, C, H, W), field_height, field_width,
+                          padding, stride, dilation)
+
+
+def col2im_6d_numpy(cols, N, C, H, W, HH, WW, pad, stride, dilation=1,
+                    out=None):
+    """
+    A vectorized drop-in replacement for col2im_6d_cython.
+
+    cols has shape (C, HH, WW, N, out_h, out_w), the layout produced by the
+    stride-trick im2col in conv_forward_strides. Rather than looping over every
+    element we loop over the HH * WW filter offsets and add each one into a
+    strided slice of the padded image. Contributions to each pixel are summed in
+    the same order as the Cython kernel, so the results are bit-identical.
+
+    If out is given the result is accumulated into it rather than into a new
+    array; it must be zero-filled and of shape (N, C, H + 2 * pad,
+    W + 2 * pad).
+    """
+    out_h = (H + 2 * pad - dilation * (HH - 1) - 1) // stride + 1
+    out_w = (W + 2 * pad - dilation * (WW - 1) - 1) // stride + 1
+    if out is None:
+        x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+    else:
+        x_padded = out
+    for hh in range(HH):
+        for ww in range(WW):
+            y0, x0 = dilation * hh, dilation * ww
+            x_slice = x_padded[:, :, y0:y0 + stride * out_h:stride,
+                               x0:x0 + stride * out_w:stride]
+            x_slice += cols[:, hh, ww].transpose(1, 0, 2, 3)
+    if pad > 0:
+        return x_padded[:, :, pad:-pad, pad:-pad]
+    return x_padded
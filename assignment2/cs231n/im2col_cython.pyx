@@ -1,6 +1,9 @@
+import os
+
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,113 +12,185 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+def _default_num_threads():
+    """
+    The first level of OMP_NUM_THREADS (which may be a comma-separated list
+    such as "4,2"), or the number of CPUs if it is unset or not a number.
+    """
+    try:
+        num_threads = int(os.environ.get('OMP_NUM_THREADS', '').split(',')[0])
+    except ValueError:
+        num_threads = 0
+    return max(0, num_threads) or os.cpu_count() or 1
+
+
+# Number of OpenMP threads used by the kernels below. Defaults to
+# OMP_NUM_THREADS if it is set and to the number of CPUs otherwise. If the
+# extension was built without OpenMP the loops simply run on one thread.
+cdef int _num_threads = _default_num_threads()
+
+
+def set_num_threads(int num_threads):
+    """ Set the number of threads used by the im2col / col2im kernels. """
+    global _num_threads
+    _num_threads = max(1, num_threads)
+
+
+def get_num_threads():
+    """ Return the number of threads used by the im2col / col2im kernels. """
+    return _num_threads
+
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
-                  int field_width, int padding, int stride):
+                  int field_width, int padding, int stride, int dilation=1,
+                  out=None):
+    """
+    im2col into an array of shape (C * field_height * field_width,
+    out_height * out_width * N). If out is given the columns are written into
+    it; it must be a contiguous array of that shape.
+    """
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
-
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
 
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
-            (C * field_height * field_width, N * HH * WW),
-            dtype=x.dtype)
-
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
-                        field_height, field_width, padding, stride)
+    cdef int HH = (H + 2 * padding - dilation * (field_height - 1) - 1) // stride + 1
+    cdef int WW = (W + 2 * padding - dilation * (field_width - 1) - 1) // stride + 1
+
+    cdef np.ndarray[DTYPE_t, ndim=2] cols
+    if out is None:
+        cols = np.empty((C * field_height * field_width, N * HH * WW),
+                        dtype=x.dtype)
+    else:
+        cols = out.reshape(C * field_height * field_width, N * HH * WW)
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, :] x_view = x
+
+    im2col_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                        field_height, field_width, padding, stride, dilation,
+                        _num_threads)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, :] x,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride, int dilation, int num_threads) nogil:
+    cdef int c, ii, jj, row, yy, xx, i, col, y, z
+
+    # x is read unpadded: taps that fall in the padding are written as zeros,
+    # and the bounds check is hoisted out of the loop over the batch.
+    # Each thread fills whole rows of cols, so the writes never overlap and
+    # walk along contiguous memory.
+    for row in prange(C * field_height * field_width, num_threads=num_threads,
+                      schedule='static'):
+        c = row // (field_height * field_width)
+        ii = (row // field_width) % field_height
+        jj = row % field_width
         for yy in range(HH):
+            y = stride * yy + dilation * ii - padding
             for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                z = stride * xx + dilation * jj - padding
+                col = yy * WW * N + xx * N
+                if 0 <= y < H and 0 <= z < W:
+                    for i in range(N):
+                        cols[row, col + i] = x[i, c, y, z]
+                else:
+                    for i in range(N):
+                        cols[row, col + i] = 0
 
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
-                  int field_height, int field_width, int padding, int stride):
+                  int field_height, int field_width, int padding, int stride,
+                  int dilation=1):
     cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
+    cdef int HH = (H + 2 * padding - dilation * (field_height - 1) - 1) // stride + 1
+    cdef int WW = (W + 2 * padding - dilation * (field_width - 1) - 1) // stride + 1
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
                                         dtype=cols.dtype)
+    cdef DTYPE_t[:, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
-                        field_height, field_width, padding, stride)
+    col2im_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                        field_height, field_width, padding, stride, dilation,
+                        _num_threads)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
     return x_padded
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride, int dilation, int num_threads) nogil:
     cdef int c, ii, jj, row, yy, xx, i, col
 
-    for c in range(C):
+    # Each channel of x_padded is only written by the rows of cols for that
+    # channel, so parallelising over channels needs no locking; within a
+    # thread every pixel still gets its contributions in the serial order.
+    for c in prange(C, num_threads=num_threads, schedule='static'):
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * field_width * field_height + ii * field_width + jj
                 for yy in range(HH):
                     for xx in range(WW):
+                        col = yy * WW * N + xx * N
                         for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                            x_padded[i, c, stride * yy + dilation * ii,
+                                     stride * xx + dilation * jj] += cols[row, col + i]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+@cython.cdivision(True)
+cdef void col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, :] cols,
+                                 DTYPE_t[:, :, :, ::1] x_padded,
+                                 int N, int C, int H, int W, int HH, int WW,
+                                 int out_h, int out_w, int pad, int stride,
+                                 int dilation, int num_threads) nogil:
+
+    cdef int nc, c, hh, ww, n, h, w
+    for nc in prange(N * C, num_threads=num_threads, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    for w in range(out_w):
+                        x_padded[n, c, stride * h + dilation * hh,
+                                 stride * w + dilation * ww] += cols[c, hh, ww, n, h, w]
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
-        int HH, int WW, int pad, int stride):
+        int HH, int WW, int pad, int stride, int dilation=1, out=None):
+    """
+    col2im for columns of shape (C, HH, WW, N, out_h, out_w). If out is given
+    the result is accumulated into it; it must be zero-filled and of shape
+    (N, C, H + 2 * pad, W + 2 * pad).
+    """
     cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int out_h = (H + 2 * pad - HH) / stride + 1
-    cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
-
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef int out_h = (H + 2 * pad - dilation * (HH - 1) - 1) // stride + 1
+    cdef int out_w = (W + 2 * pad - dilation * (WW - 1) - 1) // stride + 1
+    cdef np.ndarray[DTYPE_t, ndim=4] x_padded
+    if out is None:
+        x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+    else:
+        x_padded = out
+    cdef DTYPE_t[:, :, :, :, :, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+
+    col2im_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW, out_h, out_w,
+                           pad, stride, dilation, _num_threads)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    return x_padded
@@ -16,7 +16,7 @@ def affine_relu_forward(x, w, b):
     - cache: Object to give to the backward pass
     """
     a, fc_cache = affine_forward(x, w, b)
-    out, relu_cache = relu_forward(a)
+    out, relu_cache = relu_forward(a, inplace=True)
     cache = (fc_cache, relu_cache)
     return out, cache
 
@@ -44,7 +44,7 @@ def conv_relu_forward(x, w, b, conv_param):
     - cache: Object to give to the backward pass
     """
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    out, relu_cache = relu_forward(a)
+    out, relu_cache = relu_forward(a, inplace=True)
     cache = (conv_cache, relu_cache)
     return out, cache
 
@@ -62,7 +62,7 @@ def conv_relu_backward(dout, cache):
 def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
     an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
-    out, relu_cache = relu_forward(an)
+    out, relu_cache = relu_forward(an, inplace=True)
     cache = (conv_cache, bn_cache, relu_cache)
     return out, cache
 
@@ -79,6 +79,11 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     """
     Convenience layer that performs a convolution, a ReLU, and a pool.
 
+    The ReLU and the max commute, so we pool the convolution output first and
+    apply the ReLU to the much smaller pooled output. The pool only remembers
+    the position of each maximum, so neither the convolution output nor the
+    ReLU output is kept for the backward pass.
+
     Inputs:
     - x: Input to the convolutional layer
     - w, b, conv_param: Weights and parameters for the convolutional layer
@@ -89,9 +94,9 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     - cache: Object to give to the backward pass
     """
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    s, relu_cache = relu_forward(a)
-    out, pool_cache = max_pool_forward_fast(s, pool_param)
-    cache = (conv_cache, relu_cache, pool_cache)
+    out, pool_cache = max_pool_forward_argmax(a, pool_param)
+    np.maximum(out, 0, out=out)
+    cache = (conv_cache, pool_cache, out)
     return out, cache
 
 
@@ -99,8 +104,8 @@ def conv_relu_pool_backward(dout, cache):
     """
     Backward pass for the conv-relu-pool convenience layer
     """
-    conv_cache, relu_cache, pool_cache = cache
-    ds = max_pool_backward_fast(dout, pool_cache)
-    da = relu_backward(ds, relu_cache)
+    conv_cache, pool_cache, out = cache
+    ds = dout * (out > 0)
+    da = max_pool_backward_argmax(ds, pool_cache)
     dx, dw, db = conv_backward_fast(da, conv_cache)
     return dx, dw, db
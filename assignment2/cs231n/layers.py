@@ -64,26 +64,39 @@ def affine_backward(dout, cache):
     return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, inplace=False):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - x: Inputs, of any shape
+    - inplace: If True, write the output over x instead of allocating a new
+      array, and cache a boolean mask of the positive inputs rather than x.
+      Only pass this when nothing else still needs x, as for the freshly
+      computed pre-activations in the sandwich layers of layer_utils.py. As a
+      safety check x is only overwritten if it owns its memory and is
+      writeable; views (which may share memory with something else) get a new
+      array as usual.
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: x, or the boolean mask x > 0 if inplace was given
     """
     out = None
     ###########################################################################
     # TODO: Implement the ReLU forward pass.                                  #
     ###########################################################################
-    out = np.maximum(0,x)
+    cache = x
+    if inplace:
+        # The mask takes one byte per element instead of x's eight (or four)
+        cache = x > 0
+    if inplace and x.flags.owndata and x.flags.writeable:
+        out = np.maximum(x, 0, out=x)
+    else:
+        out = np.maximum(0,x)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
-    cache = x
     return out, cache
 
 
@@ -93,7 +106,8 @@ def relu_backward(dout, cache):
 
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: Input x, of same shape as dout, or the boolean mask cached by
+      relu_forward with inplace=True
 
     Returns:
     - dx: Gradient with respect to x
@@ -102,13 +116,40 @@ def relu_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
-    dx = np.where(x > 0, dout, 0)
+    if x.dtype == np.bool_:
+        dx = np.multiply(dout, x)
+    else:
+        dx = np.where(x > 0, dout, 0)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx
 
 
+def _welford_mean_var(x, axis=0, block_size=256):
+    """
+    Mean and (uncorrected) variance of x over axis in a single pass over x,
+    taking blocks of block_size entries along the first axis, which must be
+    one of the axes reduced over. The statistics of each block are merged into
+    the running ones with the parallel form of Welford's update (Chan et al.),
+    which stays accurate when the mean is large compared to the spread, where
+    E[x^2] - E[x]^2 would not.
+    """
+    count, mean, m2 = 0, 0., 0.
+    for start in range(0, x.shape[0], block_size):
+        xb = x[start:start + block_size]
+        block_mean = np.mean(xb, axis=axis, keepdims=True)
+        n = xb.size // block_mean.size
+        centered = xb - block_mean
+        block_m2 = np.sum(centered * centered, axis=axis, keepdims=True)
+        delta = block_mean - mean
+        total = count + n
+        mean = mean + delta * (n / total)
+        m2 = m2 + block_m2 + delta * delta * (count * n / total)
+        count = total
+    return mean.squeeze(axis=axis), (m2 / count).squeeze(axis=axis)
+
+
 def batchnorm_forward(x, gamma, beta, bn_param):
     """
     Forward pass for batch normalization.
@@ -142,10 +183,16 @@ def batchnorm_forward(x, gamma, beta, bn_param):
       - momentum: Constant for running mean / variance.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+      - stats: How the training-time mean and variance are computed:
+        'two_pass' (default) takes the mean and then the mean squared
+        deviation from it; 'welford' gets both in a single pass over blocks
+        of rows of x, merged with Welford's algorithm. Both are numerically
+        stable.
 
     Returns a tuple of:
     - out: of shape (N, D)
-    - cache: A tuple of values needed in the backward pass
+    - cache: A tuple (xhat, gamma, invstd) of the normalized data, the scale
+      parameter and 1 / sqrt(var + eps), which is all the backward pass needs
     """
     mode = bn_param['mode']
     eps = bn_param.get('eps', 1e-5)
@@ -156,8 +203,6 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
 
     out, cache = None, None
-    mu, xzero, xzerosqr, var = None, None, None, None
-    std, invstd, xhat, gx = None, None, None, None
     if mode == 'train':
         #######################################################################
         # TODO: Implement the training-time forward pass for batch norm.      #
@@ -174,38 +219,26 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         # variance, storing your result in the running_mean and running_var   #
         # variables.                                                          #
         #######################################################################
-        sample_mean = np.mean(x, axis = 0)
-        sample_var = np.var(x, axis = 0)
-        
+        stats = bn_param.get('stats', 'two_pass')
+        if stats == 'two_pass':
+            sample_mean = np.mean(x, axis = 0)
+            xhat = x - sample_mean
+            sample_var = np.einsum('ij,ij->j', xhat, xhat) / N
+        elif stats == 'welford':
+            sample_mean, sample_var = _welford_mean_var(x)
+            xhat = x - sample_mean
+        else:
+            raise ValueError('Invalid batchnorm stats "%s"' % stats)
+
         running_mean = momentum * running_mean + (1 - momentum) * sample_mean
         running_var = momentum * running_var + (1 - momentum) * sample_var
-        
-        # Step 1
-        mu = (1./N)*np.sum(x, axis = 0)
-        
-        # Step 2
-        xzero = x - mu
-        
-        # Step 3
-        xzerosqr = np.square(xzero)
-        
-        # Step 4
-        var = (1./N)*np.sum(xzerosqr, axis = 0)
-        
-        # Step 5
-        std = np.sqrt(var + eps)
-        
-        # Step 6
-        invstd = 1./std
-        
-        # Step 7
-        xhat = xzero * invstd
-        
-        # Step 8
-        gx = gamma * xhat
-        
-        # Step 9
-        out = gx + beta
+
+        # Normalize in place, so that the only full-size arrays are xhat and
+        # out
+        invstd = 1. / np.sqrt(sample_var + eps)
+        xhat *= invstd
+        out = xhat * gamma
+        out += beta
 
         #######################################################################
         #                           END OF YOUR CODE                          #
@@ -217,7 +250,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         # then scale and shift the normalized data using gamma and beta.      #
         # Store the result in the out variable.                               #
         #######################################################################+++
-        xhat = (x - running_mean)/np.sqrt(running_var + eps)
+        invstd = 1. / np.sqrt(running_var + eps)
+        xhat = (x - running_mean) * invstd
         out = gamma * xhat + beta
         #######################################################################
         #                          END OF YOUR CODE                           #
@@ -229,7 +263,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     bn_param['running_mean'] = running_mean
     bn_param['running_var'] = running_var
 
-    cache = (x, gamma, beta, bn_param, mu, xzero, xzerosqr, var, std, invstd, xhat, gx, eps)
+    cache = (xhat, gamma, invstd)
     
     return out, cache
 
@@ -256,9 +290,14 @@ def batchnorm_backward(dout, cache):
     # TODO: Implement the backward pass for batch normalization. Store the    #
     # results in the dx, dgamma, and dbeta variables.                         #
     ###########################################################################
-    x, gamma, beta, bn_param, mu, xzero, xzerosqr, var, std, invstd, xhat, gx, eps = cache
+    xhat, gamma, invstd = cache
 
-    N, D = x.shape
+    N, D = xhat.shape
+    
+    # The intermediates of the forward computation graph, rebuilt from the
+    # cache: xzero = x - mu, std = sqrt(var + eps)
+    std = 1. / invstd
+    xzero = xhat * std
     
     # Step 9
     dbeta = np.sum(dout, axis = 0)
@@ -276,10 +315,10 @@ def batchnorm_backward(dout, cache):
     dstd = -1*dinvstd/np.square(std)
     
     # Step 5
-    dvar = 0.5*dstd/np.sqrt(var + eps) 
+    dvar = 0.5*dstd*invstd
 
     # Step 4
-    dxzerosqr = (1./N)*np.ones_like(xzerosqr)*dvar # Do not have to put in the np.ones_like
+    dxzerosqr = (1./N)*np.ones_like(xzero)*dvar # Do not have to put in the np.ones_like
     
     # Step 3
     dxzero += 2 * xzero * dxzerosqr
@@ -289,7 +328,7 @@ def batchnorm_backward(dout, cache):
     dx = dxzero
    
     # Step 1
-    dx += (1./N)*np.ones_like(x)*dmu # Do not have to put in the np.ones_like
+    dx += (1./N)*np.ones_like(xzero)*dmu # Do not have to put in the np.ones_like
     
   
     ###########################################################################
@@ -310,6 +349,9 @@ def batchnorm_backward_alt(dout, cache):
     Note: This implementation should expect to receive the same cache variable
     as batchnorm_backward, but might not use all of the values in the cache.
 
+    This is the backward pass used by the networks, since it needs no
+    intermediates beyond xhat and invstd and makes fewer passes over the data.
+
     Inputs / outputs: Same as batchnorm_backward
     """
     dx, dgamma, dbeta = None, None, None
@@ -321,14 +363,15 @@ def batchnorm_backward_alt(dout, cache):
     # should be able to compute gradients with respect to the inputs in a     #
     # single statement; our implementation fits on a single 80-character line.#
     ###########################################################################
-    x, gamma, beta, bn_param, mu, xzero, xzerosqr, var, std, invstd, xhat, gx, eps = cache
+    xhat, gamma, invstd = cache
 
-    N, D = x.shape
+    N, D = xhat.shape
     
-    dxhat = dout*gamma
     dbeta = np.sum(dout, axis = 0)
-    dgamma = np.sum(xhat*dout, axis = 0)
-    dx = invstd * ( dxhat - (1./N) * (xhat * np.sum(dxhat*xhat, axis = 0) + np.sum(dxhat, axis = 0)))
+    dgamma = np.einsum('ij,ij->j', xhat, dout)
+    # dxhat = dout * gamma, so its sums over the batch are gamma * dbeta and
+    # gamma * dgamma
+    dx = (gamma * invstd) * ( dout - (1./N) * (xhat * dgamma + dbeta))
    
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -337,6 +380,56 @@ def batchnorm_backward_alt(dout, cache):
     return dx, dgamma, dbeta
 
 
+def _batchnorm_scale_shift(gamma, beta, bn_param):
+    """
+    Test-time batch normalization as an affine map per feature: returns scale
+    and shift such that batchnorm_forward in 'test' mode computes
+    x * scale + shift.
+    """
+    eps = bn_param.get('eps', 1e-5)
+    running_mean = bn_param.get('running_mean', np.zeros_like(gamma))
+    running_var = bn_param.get('running_var', np.zeros_like(gamma))
+    scale = gamma / np.sqrt(running_var + eps)
+    shift = beta - running_mean * scale
+    return scale, shift
+
+
+def batchnorm_fold(w, b, gamma, beta, bn_param):
+    """
+    Fold a test-time batch normalization layer into the affine layer before
+    it, so that affine_forward(x, w_folded, b_folded) computes the same as
+    affine_forward followed by batchnorm_forward in 'test' mode, in one
+    matrix multiply and without recomputing sqrt(running_var + eps).
+
+    Inputs:
+    - w, b: Weights of shape (D, M) and biases of shape (M,) of the affine layer
+    - gamma, beta, bn_param: Parameters of the batchnorm layer, as for
+      batchnorm_forward; the running averages in bn_param are used
+
+    Returns a tuple of:
+    - w_folded: Weights of shape (D, M)
+    - b_folded: Biases of shape (M,)
+    """
+    scale, shift = _batchnorm_scale_shift(gamma, beta, bn_param)
+    w_folded = w * scale
+    b_folded = b * scale + shift
+    return w_folded, b_folded
+
+
+def _dropout_keep(mask_seed, shape, p):
+    """
+    The boolean dropout mask for one forward pass, drawn from a generator
+    seeded with mask_seed, so the same mask_seed always gives the same mask.
+    Where NumPy has it (1.17 and later) this is a counter-based Philox
+    Generator, drawing float32 uniforms; otherwise a RandomState.
+    """
+    if hasattr(np.random, 'Philox'):
+        rng = np.random.Generator(np.random.Philox(list(mask_seed)))
+        return rng.random(shape, dtype=np.float32) < p
+    rng = np.random.RandomState(list(mask_seed))
+    return rng.random_sample(shape) < p
+
+
 def dropout_forward(x, dropout_param):
     """
     Performs the forward pass for (inverted) dropout.
@@ -344,23 +437,31 @@ def dropout_forward(x, dropout_param):
     Inputs:
     - x: Input data, of any shape
     - dropout_param: A dictionary with the following keys:
-      - p: Dropout parameter. We drop each neuron output with probability p.
+      - p: Dropout parameter. We keep each neuron output with probability p.
       - mode: 'test' or 'train'. If the mode is train, then perform dropout;
         if the mode is test, then just return the input.
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
-        in real networks.
+        in real networks: every call then uses the same mask.
+      - regenerate: If True, the cache holds only the seed of the mask, and
+        the backward pass draws the mask again instead of storing it.
+
+    Without a seed, each dropout_param gets its own stream of masks: on first
+    use a key is drawn from np.random (so np.random.seed still makes runs
+    reproducible) and stored as dropout_param['rng_key'], and the mask of the
+    t-th training pass is drawn from a generator seeded with (rng_key, t).
+    Each dropout layer should therefore have its own dropout_param.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: tuple (dropout_param, mask, mask_seed). In training mode, mask is
+      the dropout mask that was used to multiply the input, packed to one bit
+      per element with np.packbits, or None if regenerate is set; mask_seed
+      is the seed it was drawn from. In test mode, both are None.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
-    mask = None
+    mask, mask_seed = None, None
     out = None
     
     if mode == 'train':
@@ -368,9 +469,21 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.rand(*x.shape) < p) / p
-        # print('p = ', p, np.sum(mask==0)/(x.shape[0]*x.shape[1]))
-        out = np.multiply(mask, x)
+        if 'seed' in dropout_param:
+            mask_seed = (dropout_param['seed'],)
+        else:
+            if 'rng_key' not in dropout_param:
+                dropout_param['rng_key'] = np.random.randint(2 ** 31)
+                dropout_param['step'] = 0
+            mask_seed = (dropout_param['rng_key'], dropout_param['step'])
+            dropout_param['step'] += 1
+        keep = _dropout_keep(mask_seed, x.shape, p)
+
+        # Apply the 1 / p scale on the fly rather than storing a scaled mask
+        out = np.multiply(x, keep)
+        out *= 1. / p
+        if not dropout_param.get('regenerate', False):
+            mask = np.packbits(keep)
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -383,7 +496,7 @@ def dropout_forward(x, dropout_param):
         #                            END OF YOUR CODE                         #
         #######################################################################
 
-    cache = (dropout_param, mask)
+    cache = (dropout_param, mask, mask_seed)
     out = out.astype(x.dtype, copy=False)
 
     return out, cache
@@ -395,9 +508,9 @@ def dropout_backward(dout, cache):
 
     Inputs:
     - dout: Upstream derivatives, of any shape
-    - cache: (dropout_param, mask) from dropout_forward.
+    - cache: (dropout_param, mask, mask_seed) from dropout_forward.
     """
-    dropout_param, mask = cache
+    dropout_param, mask, mask_seed = cache
     mode = dropout_param['mode']
 
     dx = None
@@ -405,7 +518,12 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = np.multiply(mask, dout)
+        if mask is None:
+            keep = _dropout_keep(mask_seed, dout.shape, dropout_param['p'])
+        else:
+            keep = np.unpackbits(mask)[:dout.size].reshape(dout.shape)
+        dx = np.multiply(dout, keep)
+        dx *= 1. / dropout_param['p']
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
@@ -414,6 +532,19 @@ def dropout_backward(dout, cache):
     return dx
 
 
+def _conv_window(start, dilation, taps, size):
+    """
+    Clip a filter window to the input, so that the padding never has to be
+    materialized. The window's first tap is at position start of an input of
+    length size (start is negative when the window begins in the padding) and
+    its taps are dilation apart. Returns a slice of the taps that fall inside
+    the input and a slice of the input positions they read.
+    """
+    lo = max(0, (dilation - 1 - start) // dilation)
+    hi = max(lo, min(taps, (size - 1 - start) // dilation + 1))
+    return (slice(lo, hi),
+            slice(start + dilation * lo, start + dilation * hi, dilation))
+
 def conv_forward_naive(x, w, b, conv_param):
     """
     A naive implementation of the forward pass for a convolutional layer.
@@ -430,11 +561,13 @@ def conv_forward_naive(x, w, b, conv_param):
       - 'stride': The number of pixels between adjacent receptive fields in the
         horizontal and vertical directions.
       - 'pad': The number of pixels that will be used to zero-pad the input.
+      - 'dilation': Optional spacing between the filter taps, default 1. A
+        filter of height HH then spans HH' = dilation * (HH - 1) + 1 pixels.
 
     Returns a tuple of:
     - out: Output data, of shape (N, F, H', W') where H' and W' are given by
-      H' = 1 + (H + 2 * pad - HH) / stride
-      W' = 1 + (W + 2 * pad - WW) / stride
+      H' = 1 + (H + 2 * pad - HH') / stride
+      W' = 1 + (W + 2 * pad - WW') / stride
     - cache: (x, w, b, conv_param)
     """
     out = None
@@ -444,24 +577,26 @@ def conv_forward_naive(x, w, b, conv_param):
     ###########################################################################
     stride = conv_param['stride']
     pad = conv_param['pad']
+    d = conv_param.get('dilation', 1)
     
     N, C, H, W = x.shape
     F = b.shape[0]
     HH, WW = w.shape[2:]
+    HD, WD = d * (HH - 1) + 1, d * (WW - 1) + 1 # Dilated filter extent
     
-    HP = np.intp( 1 + (H + 2 * pad - HH) / stride)
-    WP = np.intp( 1 + (W + 2 * pad - WW) / stride)
+    HP = np.intp( 1 + (H + 2 * pad - HD) / stride)
+    WP = np.intp( 1 + (W + 2 * pad - WD) / stride)
     
-    xp = np.lib.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant') # Padded input
-    out = np.zeros( (N, F, HP, WP) )
-    wT = w.reshape((F, -1)).T
-    
-    hs = stride*np.arange(HP)
-    ws = stride*np.arange(WP)
+    # Rather than padding x, each window is clipped to x: taps that fall in
+    # the padding would only multiply zeros
+    out = np.zeros( (N, F, HP, WP), dtype=x.dtype )
     
     for i in range(HP):
+        th, xh = _conv_window(stride*i - pad, d, HH, H)
         for j in range(WP):
-            out[:,:,i,j] += np.dot(xp[:,:,hs[i]:hs[i]+HH,ws[j]:ws[j]+WW].reshape((N, -1)), wT)
+            tw, xw = _conv_window(stride*j - pad, d, WW, W)
+            wT = w[:,:,th,tw].reshape((F, -1)).T
+            out[:,:,i,j] += np.dot(x[:,:,xh,xw].reshape((N, -1)), wT)
     
     out = out + b[:, np.newaxis, np.newaxis]
     
@@ -488,11 +623,13 @@ def conv_forward_naive2(x, w, b, conv_param):
       - 'stride': The number of pixels between adjacent receptive fields in the
         horizontal and vertical directions.
       - 'pad': The number of pixels that will be used to zero-pad the input.
+      - 'dilation': Optional spacing between the filter taps, default 1. A
+        filter of height HH then spans HH' = dilation * (HH - 1) + 1 pixels.
 
     Returns a tuple of:
     - out: Output data, of shape (N, F, H', W') where H' and W' are given by
-      H' = 1 + (H + 2 * pad - HH) / stride
-      W' = 1 + (W + 2 * pad - WW) / stride
+      H' = 1 + (H + 2 * pad - HH') / stride
+      W' = 1 + (W + 2 * pad - WW') / stride
     - cache: (x, w, b, conv_param)
     """
     out = None
@@ -502,25 +639,25 @@ def conv_forward_naive2(x, w, b, conv_param):
     ###########################################################################
     stride = conv_param['stride']
     pad = conv_param['pad']
+    d = conv_param.get('dilation', 1)
     
     N, C, H, W = x.shape
     F = b.shape[0]
     HH, WW = w.shape[2:]
+    HD, WD = d * (HH - 1) + 1, d * (WW - 1) + 1 # Dilated filter extent
     
-    HP = np.intp( 1 + (H + 2 * pad - HH) / stride)
-    WP = np.intp( 1 + (W + 2 * pad - WW) / stride)
+    HP = np.intp( 1 + (H + 2 * pad - HD) / stride)
+    WP = np.intp( 1 + (W + 2 * pad - WD) / stride)
     
-    xp = np.lib.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant') # Padded input
-    out = np.zeros( (N, F, HP, WP) )
-    wT = w.reshape((F, C, -1)).T
-    
-    hs = stride*np.arange(HP)
-    ws = stride*np.arange(WP)
+    out = np.zeros( (N, F, HP, WP), dtype=x.dtype )
     
     for c in range(C):
         for i in range(HP):
+            th, xh = _conv_window(stride*i - pad, d, HH, H)
             for j in range(WP):
-                out[:,:,i,j] += np.dot(xp[:,c,hs[i]:hs[i]+HH,ws[j]:ws[j]+WW].reshape((N, -1)), wT[:,c,:])
+                tw, xw = _conv_window(stride*j - pad, d, WW, W)
+                wT = w[:,c,th,tw].reshape((F, -1)).T
+                out[:,:,i,j] += np.dot(x[:,c,xh,xw].reshape((N, -1)), wT)
     
     out = out + b[:, np.newaxis, np.newaxis]
     
@@ -555,28 +692,26 @@ def conv_backward_naive(dout, cache):
     
     stride = conv_param['stride']
     pad = conv_param['pad']
+    d = conv_param.get('dilation', 1)
     
-    xp = np.lib.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant') # Padded input - eliminate if possible
-    dxp = np.zeros_like(xp)
+    # The windows are clipped to x as in conv_forward_naive, so neither x nor
+    # dx needs padding
+    dx = np.zeros_like(x)
     dw = np.zeros_like(w)
     
-    #wT = w.reshape((F, -1)).T
-    
-    hs = stride*np.arange(HP)
-    ws = stride*np.arange(WP)
-    
     for i in range(HP):
+        th, xh = _conv_window(stride*i - pad, d, HH, x.shape[2])
         for j in range(WP):
+            tw, xw = _conv_window(stride*j - pad, d, WW, x.shape[3])
+            wi = w[:,:,th,tw]
             
             # dx
-            dxp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] += np.dot(dout[:,:,i,j], w.reshape((F, -1))).reshape((N,C,HH,WW))
+            dx[:,:,xh,xw] += np.dot(dout[:,:,i,j], wi.reshape((F, -1))).reshape((N,) + wi.shape[1:])
             
             # dw
-            #dw += np.dot(dout.T[j,i], xp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW].reshape((N, -1))).reshape(w.shape)
-            dw += np.dot(dout[:,:,i,j].T, xp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW].reshape((N, -1))).reshape(w.shape)
+            dw[:,:,th,tw] += np.dot(dout[:,:,i,j].T, x[:,:,xh,xw].reshape((N, -1))).reshape(wi.shape)
     
     db = np.sum(dout, axis = (0,2,3))
-    dx = dxp[:,:,pad:-pad, pad:-pad]
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -584,6 +719,77 @@ def conv_backward_naive(dout, cache):
     return dx, dw, db
 
 
+def conv_forward_grouped_naive(x, w, b, conv_param):
+    """
+    A naive implementation of the forward pass for a grouped convolution.
+
+    The C input channels and the F filters are split into G equal groups, and
+    the filters in group g only see the input channels in group g. With G = C
+    this is a depthwise convolution.
+
+    Input:
+    - x: Input data of shape (N, C, H, W)
+    - w: Filter weights of shape (F, C / G, HH, WW)
+    - b: Biases, of shape (F,)
+    - conv_param: A dictionary with the same keys as for conv_forward_naive,
+      plus:
+      - 'groups': The number of groups G; both C and F must be divisible by it.
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, F, H', W') as for conv_forward_naive
+    - cache: (x, w, b, conv_param)
+    """
+    G = conv_param.get('groups', 1)
+    C, F = x.shape[1], w.shape[0]
+    assert C % G == 0, 'channels must be divisible by groups'
+    assert F % G == 0, 'filters must be divisible by groups'
+    assert w.shape[1] == C // G, 'w must have C / groups channels'
+    Cg, Fg = C // G, F // G
+
+    out = []
+    for g in range(G):
+        xg = x[:, g * Cg:(g + 1) * Cg]
+        wg, bg = w[g * Fg:(g + 1) * Fg], b[g * Fg:(g + 1) * Fg]
+        out.append(conv_forward_naive(xg, wg, bg, conv_param)[0])
+    out = np.concatenate(out, axis=1)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_grouped_naive(dout, cache):
+    """
+    A naive implementation of the backward pass for a grouped convolution.
+
+    Inputs:
+    - dout: Upstream derivatives.
+    - cache: A tuple of (x, w, b, conv_param) as in conv_forward_grouped_naive
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param = cache
+    G = conv_param.get('groups', 1)
+    Cg, Fg = x.shape[1] // G, w.shape[0] // G
+
+    dx, dw, db = [], [], []
+    for g in range(G):
+        group_cache = (x[:, g * Cg:(g + 1) * Cg], w[g * Fg:(g + 1) * Fg],
+                       b[g * Fg:(g + 1) * Fg], conv_param)
+        dxg, dwg, dbg = conv_backward_naive(dout[:, g * Fg:(g + 1) * Fg],
+                                            group_cache)
+        dx.append(dxg)
+        dw.append(dwg)
+        db.append(dbg)
+
+    dx = np.concatenate(dx, axis=1)
+    dw = np.concatenate(dw, axis=0)
+    db = np.concatenate(db, axis=0)
+    return dx, dw, db
+
+
 def max_pool_forward_naive(x, pool_param):
     """
     A naive implementation of the forward pass for a max pooling layer.
@@ -594,6 +800,8 @@ def max_pool_forward_naive(x, pool_param):
       - 'pool_height': The height of each pooling region
       - 'pool_width': The width of each pooling region
       - 'stride': The distance between adjacent pooling regions
+      - 'pad': Optional number of pixels of -inf padding on each side,
+        default 0. Must be smaller than the pool size.
 
     Returns a tuple of:
     - out: Output data
@@ -606,10 +814,12 @@ def max_pool_forward_naive(x, pool_param):
     
     N, C, H, W = x.shape
     HH, WW, stride = pool_param['pool_height'], pool_param['pool_width'], pool_param['stride']
+    pad = pool_param.get('pad', 0)
     
-    HP = np.intp( 1 + (H - HH) / stride)
-    WP = np.intp( 1 + (W - WW) / stride)
+    HP = np.intp( 1 + (H + 2 * pad - HH) / stride)
+    WP = np.intp( 1 + (W + 2 * pad - WW) / stride)
     
+    xp = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant', constant_values=-np.inf) # Padded input
     hs = stride*np.arange(HP)
     ws = stride*np.arange(WP)
     
@@ -617,7 +827,7 @@ def max_pool_forward_naive(x, pool_param):
 
     for i in range(HP):
         for j in range(WP):
-            out[:,:,i,j] = np.amax(x[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW], axis = (2,3))
+            out[:,:,i,j] = np.amax(xp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW], axis = (2,3))
                         
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -645,19 +855,22 @@ def max_pool_backward_naive(dout, cache):
     
     N, C, HP, WP = dout.shape
     HH, WW, stride = pool_param['pool_height'], pool_param['pool_width'], pool_param['stride']
+    pad = pool_param.get('pad', 0)
     
     hs = stride*np.arange(HP)
     ws = stride*np.arange(WP)
     
-    dx = np.zeros_like(x)
+    xp = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant', constant_values=-np.inf) # Padded input
+    dxp = np.zeros_like(xp)
     #dx2 =  np.zeros_like(x)
     
     for n in range(N):
         for c in range(C):
             for i in range(HP):
                 for j in range(WP):
-                    ismax = x[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] == np.amax(x[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] ) 
-                    dx[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] += ismax*dout[n,c,i,j]
+                    ismax = xp[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] == np.amax(xp[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] ) 
+                    dxp[n,c,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] += ismax*dout[n,c,i,j]
+    dx = dxp[:,:,pad:pad+x.shape[2], pad:pad+x.shape[3]]
     
    # for n in range(N):
    #     for c in range(C):
@@ -680,6 +893,116 @@ def max_pool_backward_naive(dout, cache):
     return dx
 
 
+def avg_pool_forward_naive(x, pool_param):
+    """
+    A naive implementation of the forward pass for an average pooling layer.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+    - pool_param: dictionary with the following keys:
+      - 'pool_height': The height of each pooling region
+      - 'pool_width': The width of each pooling region
+      - 'stride': The distance between adjacent pooling regions
+      - 'pad': Optional number of pixels of zero padding on each side,
+        default 0. The padding counts towards the average.
+
+    Returns a tuple of:
+    - out: Output data
+    - cache: (x, pool_param)
+    """
+    N, C, H, W = x.shape
+    HH, WW, stride = pool_param['pool_height'], pool_param['pool_width'], pool_param['stride']
+    pad = pool_param.get('pad', 0)
+    
+    HP = np.intp( 1 + (H + 2 * pad - HH) / stride)
+    WP = np.intp( 1 + (W + 2 * pad - WW) / stride)
+    
+    xp = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant') # Padded input
+    hs = stride*np.arange(HP)
+    ws = stride*np.arange(WP)
+    
+    out = np.zeros( (N, C, HP, WP), dtype=x.dtype )
+
+    for i in range(HP):
+        for j in range(WP):
+            out[:,:,i,j] = np.mean(xp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW], axis = (2,3))
+
+    cache = (x, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_naive(dout, cache):
+    """
+    A naive implementation of the backward pass for an average pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives
+    - cache: A tuple of (x, pool_param) as in the forward pass.
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x, pool_param = cache
+    
+    N, C, HP, WP = dout.shape
+    HH, WW, stride = pool_param['pool_height'], pool_param['pool_width'], pool_param['stride']
+    pad = pool_param.get('pad', 0)
+    
+    hs = stride*np.arange(HP)
+    ws = stride*np.arange(WP)
+    
+    # Every element of a window gets an equal share of its gradient
+    dxp = np.zeros( (N, C, x.shape[2] + 2 * pad, x.shape[3] + 2 * pad), dtype=dout.dtype )
+    for i in range(HP):
+        for j in range(WP):
+            dxp[:,:,hs[i]:hs[i]+HH, ws[j]:ws[j]+WW] += dout[:,:,i,j,np.newaxis,np.newaxis] / (HH * WW)
+    dx = dxp[:,:,pad:pad+x.shape[2], pad:pad+x.shape[3]]
+    
+    return dx
+
+
+def global_avg_pool_forward(x, pool_param=None):
+    """
+    Forward pass for a global average pooling layer, which averages each
+    channel over all of its spatial positions.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+    - pool_param: Optional dictionary; if its 'layout' key is 'NHWC' then x has
+      shape (N, H, W, C) instead.
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C)
+    - cache: (x.shape, pool_param)
+    """
+    if pool_param is not None and pool_param.get('layout', 'NCHW') == 'NHWC':
+        out = x.mean(axis=(1, 2))
+    else:
+        out = x.mean(axis=(2, 3))
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+    """
+    Backward pass for a global average pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C)
+    - cache: (x_shape, pool_param) from global_avg_pool_forward
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x_shape, pool_param = cache
+    dx = np.empty(x_shape, dtype=dout.dtype)
+    if pool_param is not None and pool_param.get('layout', 'NCHW') == 'NHWC':
+        dx[...] = dout[:, np.newaxis, np.newaxis, :] / (x_shape[1] * x_shape[2])
+    else:
+        dx[...] = dout[:, :, np.newaxis, np.newaxis] / (x_shape[2] * x_shape[3])
+    return dx
+
+
 def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     """
     Computes the forward pass for spatial batch normalization.
@@ -697,9 +1020,13 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
         default of momentum=0.9 should work well in most situations.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+      - layout: 'NCHW' (default) or 'NHWC'. With 'NHWC' x has shape
+        (N, H, W, C), and since the channels are already last no transpose
+        is needed.
+      - stats: 'two_pass' (default) or 'welford', as for batchnorm_forward
 
     Returns a tuple of:
-    - out: Output data, of shape (N, C, H, W)
+    - out: Output data, of the same shape as x
     - cache: Values needed for the backward pass
     """
     out, cache = None, None
@@ -711,12 +1038,52 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     # version of batch normalization defined above. Your implementation should#
     # be very short; ours is less than five lines.                            #
     ###########################################################################
+    if bn_param.get('layout', 'NCHW') == 'NHWC':
+        out, cache = batchnorm_forward(x.reshape((-1, x.shape[3])), gamma, beta, bn_param)
+        return out.reshape(x.shape), ('NHWC', cache)
+
+    # For NCHW data reduce over the batch and spatial axes directly, with the
+    # per-channel statistics kept as (1, C, 1, 1) arrays for broadcasting;
+    # transposing to (N*H*W, C) for batchnorm_forward would copy x and out
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
     N, C, H, W = x.shape
-    
-    out, cache = batchnorm_forward(np.transpose(x, (0, 2, 3, 1)).reshape( (-1, C)), gamma, beta, bn_param)
-    out = np.reshape(out, (N, H, W, C))
-    out = np.transpose(out, (0, 3, 1, 2))
-   
+    M = N * H * W
+    axes = (0, 2, 3)
+    running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+    if mode == 'train':
+        stats = bn_param.get('stats', 'two_pass')
+        if stats == 'two_pass':
+            sample_mean = np.mean(x, axis = axes)
+            xhat = x - sample_mean[:, np.newaxis, np.newaxis]
+            sample_var = np.einsum('nchw,nchw->c', xhat, xhat) / M
+        elif stats == 'welford':
+            sample_mean, sample_var = _welford_mean_var(x, axis = axes)
+            xhat = x - sample_mean[:, np.newaxis, np.newaxis]
+        else:
+            raise ValueError('Invalid batchnorm stats "%s"' % stats)
+
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+        running_var = momentum * running_var + (1 - momentum) * sample_var
+
+        invstd = 1. / np.sqrt(sample_var + eps)
+        xhat *= invstd[:, np.newaxis, np.newaxis]
+    elif mode == 'test':
+        invstd = 1. / np.sqrt(running_var + eps)
+        xhat = (x - running_mean[:, np.newaxis, np.newaxis]) * invstd[:, np.newaxis, np.newaxis]
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
+    out = xhat * gamma[:, np.newaxis, np.newaxis]
+    out += beta[:, np.newaxis, np.newaxis]
+    cache = ('NCHW', (xhat, gamma, invstd))
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -730,11 +1097,12 @@ def spatial_batchnorm_backward(dout, cache):
     Computes the backward pass for spatial batch normalization.
 
     Inputs:
-    - dout: Upstream derivatives, of shape (N, C, H, W)
+    - dout: Upstream derivatives, of shape (N, C, H, W), or (N, H, W, C) if
+      the forward pass used the 'NHWC' layout
     - cache: Values from the forward pass
 
     Returns a tuple of:
-    - dx: Gradient with respect to inputs, of shape (N, C, H, W)
+    - dx: Gradient with respect to inputs, of the same shape as dout
     - dgamma: Gradient with respect to scale parameter, of shape (C,)
     - dbeta: Gradient with respect to shift parameter, of shape (C,)
     """
@@ -747,11 +1115,23 @@ def spatial_batchnorm_backward(dout, cache):
     # version of batch normalization defined above. Your implementation should#
     # be very short; ours is less than five lines.                            #
     ###########################################################################
+    layout, cache = cache
+    if layout == 'NHWC':
+        dx, dgamma, dbeta = batchnorm_backward_alt(dout.reshape((-1, dout.shape[3])), cache)
+        return dx.reshape(dout.shape), dgamma, dbeta
+
+    # The simplified expression of batchnorm_backward_alt, with the sums
+    # taken over the batch and spatial axes of the NCHW arrays
+    xhat, gamma, invstd = cache
     N, C, H, W = dout.shape
+    M = N * H * W
     
-    dx, dgamma, dbeta = batchnorm_backward(np.transpose(dout, (0, 2, 3, 1)).reshape( (-1, C)), cache)
-    dx = np.reshape(dx, (N, H, W, C))
-    dx = np.transpose(dx, (0, 3, 1, 2))
+    dbeta = np.sum(dout, axis = (0, 2, 3))
+    dgamma = np.einsum('nchw,nchw->c', xhat, dout)
+    dx = xhat * (dgamma / M)[:, np.newaxis, np.newaxis]
+    dx += (dbeta / M)[:, np.newaxis, np.newaxis]
+    np.subtract(dout, dx, out = dx)
+    dx *= (gamma * invstd)[:, np.newaxis, np.newaxis]
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -759,6 +1139,26 @@ def spatial_batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def spatial_batchnorm_fold(w, b, gamma, beta, bn_param):
+    """
+    Fold a test-time spatial batch normalization layer into the convolutional
+    layer before it; like batchnorm_fold, but each filter is scaled.
+
+    Inputs:
+    - w, b: Filter weights of shape (F, C, HH, WW) and biases of shape (F,)
+    - gamma, beta, bn_param: Parameters of the spatial batchnorm layer, as for
+      spatial_batchnorm_forward
+
+    Returns a tuple of:
+    - w_folded: Filter weights of shape (F, C, HH, WW)
+    - b_folded: Biases of shape (F,)
+    """
+    scale, shift = _batchnorm_scale_shift(gamma, beta, bn_param)
+    w_folded = w * scale[:, np.newaxis, np.newaxis, np.newaxis]
+    b_folded = b * scale + shift
+    return w_folded, b_folded
+
+
 def svm_loss(x, y):
     """
     Computes the loss and gradient using for multiclass SVM classification.
@@ -786,27 +1186,256 @@ def svm_loss(x, y):
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, label_smoothing=0.0, class_weights=None):
     """
     Computes the loss and gradient for softmax classification.
 
+    The softmax and the cross-entropy are fused: the shifted scores are
+    exponentiated once, into the array that then becomes the gradient, and
+    the log-probabilities the loss needs are taken from the scores and the
+    per-row log-sum-exp rather than from a second full-size log or exp. dx
+    has the same dtype as x, and shifting by the row maximum keeps the
+    computation stable in float32.
+
     Inputs:
     - x: Input data, of shape (N, C) where x[i, j] is the score for the jth
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - label_smoothing: The target distribution for x[i] puts
+      1 - label_smoothing on y[i] and spreads label_smoothing evenly over all
+      C classes. The default of 0 gives the usual one-hot targets.
+    - class_weights: Optional array of shape (C,). If given, the loss of x[i]
+      is weighted by class_weights[y[i]], and the total is divided by the sum
+      of these weights rather than by N.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
-    N = x.shape[0]
-    loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
-    dx[np.arange(N), y] -= 1
-    dx /= N
+    N, C = x.shape
+    rows = np.arange(N)
+
+    shift = np.max(x, axis=1, keepdims=True)
+    dx = np.subtract(x, shift)
+    np.exp(dx, out=dx)
+    Z = np.sum(dx, axis=1, keepdims=True)
+    log_Z = shift + np.log(Z)
+
+    # Loss of each example: -log p[i, y[i]], plus with label smoothing the
+    # mean of -log p[i, j] over all classes, which is log_Z - mean_j x[i, j]
+    sample_loss = log_Z[:, 0] - x[rows, y]
+    if label_smoothing:
+        sample_loss *= 1 - label_smoothing
+        sample_loss += label_smoothing * (log_Z[:, 0] - np.mean(x, axis=1))
+
+    if class_weights is None:
+        sample_scale = 1. / N
+        loss = np.sum(sample_loss) * sample_scale
+    else:
+        sample_weights = np.asarray(class_weights)[y]
+        sample_scale = (sample_weights / np.sum(sample_weights))[:, np.newaxis]
+        loss = np.dot(sample_loss, sample_scale[:, 0])
+
+    # dx = (softmax(x) - targets) * scale, written over the exponentials
+    dx /= Z
+    if label_smoothing:
+        dx -= label_smoothing / C
+    dx[rows, y] -= 1 - label_smoothing
+    dx *= sample_scale
     return loss, dx
+
+
+def _sample_classes(num_classes, sample_param):
+    """
+    Draws sample_param['num_sampled'] classes, with replacement, from the
+    proposal distribution named by sample_param['sampler'].
+    """
+    num_sampled = sample_param['num_sampled']
+    sampler = sample_param.get('sampler', 'log_uniform')
+    rng = np.random
+    if 'seed' in sample_param:
+        rng = np.random.RandomState(sample_param['seed'])
+
+    if sampler == 'uniform':
+        return rng.randint(num_classes, size=num_sampled)
+    elif sampler == 'log_uniform':
+        u = rng.rand(num_sampled)
+        sampled = np.exp(u * np.log(num_classes + 1.)).astype(np.intp) - 1
+        return np.minimum(sampled, num_classes - 1)
+    else:
+        raise ValueError('Unrecognized sampler "%s"' % sampler)
+
+
+def _log_expected_count(classes, num_classes, sample_param):
+    """
+    The log of the number of times each of classes is expected to be drawn by
+    _sample_classes with the same sample_param.
+    """
+    sampler = sample_param.get('sampler', 'log_uniform')
+    if sampler == 'uniform':
+        q = np.full(classes.shape, 1. / num_classes)
+    elif sampler == 'log_uniform':
+        q = np.log1p(1. / (classes + 1.)) / np.log(num_classes + 1.)
+    else:
+        raise ValueError('Unrecognized sampler "%s"' % sampler)
+    return np.log(sample_param['num_sampled'] * q)
+
+
+def sampled_softmax_loss(x, w, b, y, sample_param):
+    """
+    Computes a sampled approximation to an affine layer followed by the softmax
+    loss, and its gradients, for training with many classes.
+
+    Rather than scoring every example against all C classes, each example is
+    scored against its own label and against num_sampled classes drawn once
+    for the whole minibatch from a proposal distribution. The scores of the
+    sampled classes are corrected by the log of their expected count under
+    the proposal, so that the loss estimates the full softmax loss. The loss
+    should only be used for training; evaluate the model with the full affine
+    layer.
+
+    This cuts the matrix multiplies and the softmax from O(N * D * C) to
+    O(N * D * num_sampled), but it does not make a training step sublinear in
+    C. dw and db are returned as dense arrays of the full shapes, as the
+    solver's update rules expect, with only the columns of the classes used
+    being nonzero; zeroing them, the L2 penalty on w and the update of w all
+    remain O(D * C).
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - w: Weights of the output layer, of shape (D, C)
+    - b: Biases of the output layer, of shape (C,)
+    - y: Vector of labels, of shape (N,)
+    - sample_param: Dictionary with the following keys:
+      - num_sampled: Number of classes to sample for the minibatch.
+      - sampler: 'log_uniform' (default), where the probability of class c
+        falls off as log((c + 2) / (c + 1)) and so suits classes sorted by
+        decreasing frequency, or 'uniform'.
+      - remove_accidental_hits: If True (the default), a sampled class that
+        is the label of an example is not counted against that example.
+      - seed: If given, the classes are sampled with this seed, so that
+        every call draws the same ones; this is for gradient checking.
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient with respect to x, of shape (N, D)
+    - dw: Gradient with respect to w, of shape (D, C)
+    - db: Gradient with respect to b, of shape (C,)
+    """
+    N = x.shape[0]
+    C = w.shape[1]
+    sampled = _sample_classes(C, sample_param)
+
+    # Column 0 holds the score of the label, the others those of the samples
+    w_true, w_sampled = w[:, y], w[:, sampled]
+    logits = np.empty((N, 1 + sampled.size), dtype=np.result_type(x, w))
+    logits[:, 0] = np.einsum('ij,ji->i', x, w_true) + b[y]
+    logits[:, 1:] = x.dot(w_sampled) + b[sampled]
+    # Weighting the sampled terms by 1 / expected count makes their sum an
+    # estimate of the partition function over the classes other than y[i]
+    logits[:, 1:] -= _log_expected_count(sampled, C, sample_param)
+    if sample_param.get('remove_accidental_hits', True):
+        logits[:, 1:][sampled == y[:, np.newaxis]] = -np.inf
+
+    loss, dlogits = softmax_loss(logits, np.zeros(N, dtype=np.intp))
+
+    dx = dlogits[:, 1:].dot(w_sampled.T)
+    dx += dlogits[:, :1] * w_true.T
+
+    # Gather the gradients into one column per distinct class used, so that
+    # repeated classes are summed by a small matrix multiply, and only those
+    # columns of dw and db are written
+    classes, inverse = np.unique(np.concatenate((y, sampled)),
+                                 return_inverse=True)
+    onehot = np.eye(classes.size, dtype=dlogits.dtype)[inverse[N:]]
+    dscores = dlogits[:, 1:].dot(onehot)
+    dscores[np.arange(N), inverse[:N]] += dlogits[:, 0]
+    dw = np.zeros_like(w)
+    dw[:, classes] = x.T.dot(dscores)
+    db = np.zeros_like(b)
+    db[classes] = np.sum(dscores, axis=0)
+    return loss, dx, dw, db
+
+
+def hierarchical_softmax_loss(x, w, b, wc, bc, y):
+    """
+    Computes the loss and gradients of a two-level hierarchical softmax.
+
+    The C classes are split into K = wc.shape[1] clusters of consecutive
+    classes, each of size ceil(C / K) except perhaps the last. The probability
+    of class c in cluster k is p(k | x) * p(c | k, x), where p(k | x) is the
+    softmax of x.dot(wc) + bc over clusters and p(c | k, x) is the softmax of
+    x.dot(w) + b over the classes of cluster k. Training an example touches
+    only the K cluster columns and the columns of its own cluster, so with
+    K ~ sqrt(C) the matrix multiplies and softmaxes cost O(D * sqrt(C)) per
+    example rather than O(D * C). As with sampled_softmax_loss this does not
+    make a training step sublinear in C: dw and db are dense, and zeroing
+    them, the L2 penalty and the update of w remain O(D * C).
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - w, b: Weights and biases of the classes, of shape (D, C) and (C,)
+    - wc, bc: Weights and biases of the clusters, of shape (D, K) and (K,)
+    - y: Vector of labels, of shape (N,)
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient with respect to x
+    - dw, db: Gradients with respect to w and b
+    - dwc, dbc: Gradients with respect to wc and bc
+    """
+    N = x.shape[0]
+    C = w.shape[1]
+    cluster_size = -(-C // wc.shape[1])
+    clusters = y // cluster_size
+
+    loss, dscores = softmax_loss(x.dot(wc) + bc, clusters)
+    dx = dscores.dot(wc.T)
+    dwc = x.T.dot(dscores)
+    dbc = np.sum(dscores, axis=0)
+
+    # Softmax over the classes of each cluster, for the examples in it
+    dw = np.zeros_like(w)
+    db = np.zeros_like(b)
+    for k in np.unique(clusters):
+        rows = np.flatnonzero(clusters == k)
+        cols = slice(k * cluster_size, min((k + 1) * cluster_size, C))
+        x_k = x[rows]
+        cluster_loss, dscores = softmax_loss(x_k.dot(w[:, cols]) + b[cols],
+                                             y[rows] - k * cluster_size)
+        # softmax_loss averages over the rows of the cluster, not the batch
+        dscores *= float(rows.size) / N
+        loss += cluster_loss * rows.size / N
+        dx[rows] += dscores.dot(w[:, cols].T)
+        dw[:, cols] = x_k.T.dot(dscores)
+        db[cols] = np.sum(dscores, axis=0)
+
+    return loss, dx, dw, db, dwc, dbc
+
+
+def hierarchical_softmax_scores(x, w, b, wc, bc):
+    """
+    Computes the exact log-probabilities of all C classes under the
+    hierarchical softmax of hierarchical_softmax_loss, for evaluation.
+
+    Inputs: Same as hierarchical_softmax_loss, without y.
+
+    Returns:
+    - scores: Array of shape (N, C) with scores[i, c] = log p(c | x[i])
+    """
+    C = w.shape[1]
+    cluster_size = -(-C // wc.shape[1])
+    clusters = np.arange(C) // cluster_size
+    starts = np.arange(0, C, cluster_size)
+
+    cluster_scores = x.dot(wc) + bc
+    cluster_scores -= np.max(cluster_scores, axis=1, keepdims=True)
+    cluster_scores -= np.log(np.sum(np.exp(cluster_scores), axis=1,
+                                    keepdims=True))
+
+    scores = x.dot(w) + b
+    scores -= np.maximum.reduceat(scores, starts, axis=1)[:, clusters]
+    log_Z = np.log(np.add.reduceat(np.exp(scores), starts, axis=1))
+    scores += cluster_scores[:, clusters] - log_Z[:, clusters]
+    return scores
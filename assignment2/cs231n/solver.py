@@ -9,6 +9,7 @@ import pickle as pickle
 import numpy as np
 
 from cs231n import optim
+from cs231n.workspace import Workspace
 
 
 class Solver(object):
@@ -113,6 +114,12 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - use_workspace: Boolean; if set to true then the scratch buffers of
+          the fast layers are drawn from a Workspace (see workspace.py) that is
+          reset at each step, so that they are reused across iterations rather
+          than allocated afresh. The workspace is available as
+          solver.workspace, and solver.workspace.stats() reports how many bytes
+          were allocated and reused.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -132,6 +139,7 @@ class Solver(object):
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        use_workspace = kwargs.pop('use_workspace', False)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -144,6 +152,8 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        self.workspace = Workspace() if use_workspace else None
+
         self._reset()
 
 
@@ -179,7 +189,7 @@ class Solver(object):
         y_batch = self.y_train[batch_mask]
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        loss, grads = self._loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
         # Perform a parameter update
@@ -191,6 +201,19 @@ class Solver(object):
             self.optim_configs[p] = next_config
 
 
+    def _loss(self, X, y=None):
+        """
+        Call model.loss, drawing scratch buffers from the workspace if there is
+        one. Nothing from the previous call is needed any more, so first all of
+        the buffers are returned to the workspace's pool.
+        """
+        if self.workspace is None:
+            return self.model.loss(X, y)
+        self.workspace.reset()
+        with self.workspace:
+            return self.model.loss(X, y)
+
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None: return
         checkpoint = {
@@ -246,7 +269,7 @@ class Solver(object):
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
+            scores = self._loss(X[start:end])
             y_pred.append(np.argmax(scores, axis=1))
         y_pred = np.hstack(y_pred)
         acc = np.mean(y_pred == y)
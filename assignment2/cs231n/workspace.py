@@ -0,0 +1,152 @@
+"""
+A workspace arena for the scratch buffers of the fast layers.
+
+The fast layers need large temporary arrays (padded inputs, im2col columns,
+col2im accumulators, pooling masks) whose shapes are the same on every
+iteration of training. Rather than allocating them afresh each time, the
+kernels ask this module for them with empty() and zeros(). When a Workspace is
+active these come out of its pool of buffers, keyed by shape and dtype;
+otherwise they are ordinary new arrays.
+
+Buffers handed out by a workspace stay in use until its reset() method is
+called, after which they may be handed out again. So a workspace must only be
+reset once nothing from the previous forward and backward pass is needed; the
+Solver does this at the start of each step when given use_workspace=True.
+Kernels that are done with a scratch buffer before then can hand it back early
+with release().
+
+Example usage:
+
+ws = Workspace()
+for t in range(num_iterations):
+    ws.reset()
+    with ws:
+        loss, grads = model.loss(X_batch, y_batch)
+    ...
+print(ws.stats())
+"""
+from builtins import object
+
+import numpy as np
+
+
+# The workspace that empty() and zeros() draw from, or None
+_active = None
+
+
+class Workspace(object):
+    """
+    A pool of reusable arrays, keyed by shape and dtype.
+
+    The counters bytes_allocated and bytes_reused (and num_allocated and
+    num_reused) record how much of what was handed out had to be newly
+    allocated and how much came from the pool; in steady-state training
+    everything should be reused.
+    """
+
+    def __init__(self):
+        self.free = {}
+        self.in_use = []
+        self.bytes_allocated = 0
+        self.bytes_reused = 0
+        self.num_allocated = 0
+        self.num_reused = 0
+        self._previous = []
+
+    def empty(self, shape, dtype=np.float64):
+        """ An uninitialized array of the given shape and dtype. """
+        if not isinstance(shape, tuple):
+            shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        key = (shape, np.dtype(dtype).str)
+        buffers = self.free.get(key)
+        if buffers:
+            a = buffers.pop()
+            self.bytes_reused += a.nbytes
+            self.num_reused += 1
+        else:
+            a = np.empty(shape, dtype=dtype)
+            self.bytes_allocated += a.nbytes
+            self.num_allocated += 1
+        self.in_use.append((key, a))
+        # Hand out a view, so that callers can set its shape without changing
+        # the buffer kept in the pool
+        return a.view()
+
+    def zeros(self, shape, dtype=np.float64):
+        """ An array of zeros of the given shape and dtype. """
+        a = self.empty(shape, dtype)
+        a.fill(0)
+        return a
+
+    def release(self, a):
+        """
+        Return the buffer behind the array a (which may be a view of it) to
+        the pool early, once the caller knows nothing else refers to it.
+        """
+        while isinstance(a.base, np.ndarray):
+            a = a.base
+        for k, (key, b) in enumerate(self.in_use):
+            if b is a:
+                del self.in_use[k]
+                self.free.setdefault(key, []).append(b)
+                return
+
+    def reset(self):
+        """
+        Return every buffer handed out since the last reset to the pool.
+        """
+        for key, a in self.in_use:
+            self.free.setdefault(key, []).append(a)
+        self.in_use = []
+
+    def clear(self):
+        """ Drop all buffers, including the ones in use, and the counters. """
+        self.__init__()
+
+    def stats(self):
+        """ A dictionary of the allocation counters and the pool size. """
+        pooled = sum(a.nbytes for buffers in self.free.values()
+                     for a in buffers)
+        pooled += sum(a.nbytes for _, a in self.in_use)
+        return {
+            'bytes_allocated': self.bytes_allocated,
+            'bytes_reused': self.bytes_reused,
+            'num_allocated': self.num_allocated,
+            'num_reused': self.num_reused,
+            'bytes_pooled': pooled,
+        }
+
+    def __enter__(self):
+        global _active
+        self._previous.append(_active)
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = self._previous.pop()
+
+
+def active_workspace():
+    """ The workspace that empty() and zeros() currently draw from, or None """
+    return _active
+
+
+def empty(shape, dtype=np.float64):
+    """ np.empty, drawing from the active workspace if there is one """
+    if _active is None:
+        return np.empty(shape, dtype=dtype)
+    return _active.empty(shape, dtype)
+
+
+def release(a):
+    """ Return a buffer to the active workspace, if there is one, early """
+    if _active is not None:
+        _active.release(a)
+
+
+def zeros(shape, dtype=np.float64):
+    """ np.zeros, drawing from the active workspace if there is one """
+    if _active is None:
+        return np.zeros(shape, dtype=dtype)
+    return _active.zeros(shape, dtype)